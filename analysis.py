@@ -1,20 +1,24 @@
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point, Polygon
-import matplotlib.pyplot as plt
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from h3 import h3
 import datetime
 import numpy as np
-plt.rcParams['figure.figsize'] = [10, 10]
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
 import my_h3_functions as myh3
+import home_location as home
+import communicationwmongo as commu
+from instrumentation import JobMetrics
+import dataaccess
 
 def read_radios_from_db(db, collectionname='radios'):
     """Takes results stored in the radios Mongo collection, prepares a gdf for analysis"""
+    import geopandas as gpd
+    from shapely.geometry import Polygon
 
-
-    df = pd.DataFrame(list(db[collectionname].find()))
+    df = pd.DataFrame(list(db[collectionname].find({}, {'COD_2010_1': 1, 'geometry': 1, 'tweets.totalcount': 1})))
 
     # rearrange total counts
     df['totalcount'] = df.apply(lambda x: x['tweets']['totalcount'], axis=1)
@@ -35,6 +39,9 @@ def read_radios_from_db(db, collectionname='radios'):
 
 def graph_total_counts(gdf):
     """Graphs total counts"""
+    import matplotlib.pyplot as plt
+    plt.rcParams['figure.figsize'] = [10, 10]
+
     fig, ax = plt.subplots()
     base=gdf.loc[gdf['totalcount']<10000].plot(column='totalcount', ax=ax)
     base.set_xlim(-59, -58.0)
@@ -95,15 +102,58 @@ def iteratorofpendinggeometries(db,collection_destination_name):
 
 
     # recall the transformation to geojson is taken care by geopandas.__geointerface__ etc
+    import geopandas as gpd
+
     def f(x):
         return {'COD_2010_1': x['COD_2010_1'],
                 'geometry': gpd.GeoSeries(x['geometry']).__geo_interface__['features'][0]['geometry']}
 
     print('Number of pending geometries...', gdf.loc[gdf['completed'] == False].shape[0])
-    return iter(list(gdf.loc[gdf['completed'] == False].apply(f, axis=1)))
+    # (apply on an empty dataframe would return the columns)
+    return iter([f(row) for _, row in gdf.loc[gdf['completed'] == False].iterrows()])
+
+
+def _done_collection_name(collection_destination_name):
+    "Collection with the codes of completed geometries that have no results (see insert_geometry_results)"
+    return collection_destination_name + '_done'
+
 
+def _pendinggeometries_pipeline(collection_destination_name):
+    """Aggregation pipeline of radios neither stored in the destination collection nor marked as done
+    (anti-join on COD_2010_1)"""
+    return [{'$project': {'_id': 0, 'COD_2010_1': 1, 'geometry': 1}},
+            {'$lookup': {'from': collection_destination_name, 'localField': 'COD_2010_1',
+                         'foreignField': 'COD_2010_1', 'as': 'completed'}},
+            {'$lookup': {'from': _done_collection_name(collection_destination_name), 'localField': 'COD_2010_1',
+                         'foreignField': 'COD_2010_1', 'as': 'done'}},
+            {'$match': {'completed': {'$size': 0}, 'done': {'$size': 0}}},
+            {'$project': {'COD_2010_1': 1, 'geometry': 1}}]
+
+
+def pendinggeometries(db, collection_destination_name, radioscollection='radios', batch_size=100):
+
+    """Lightweight version of iteratorofpendinggeometries.
+    Pending radios are found in the database with an anti-join ($lookup on COD_2010_1 to the destination collection),
+    and only their code and geometry are read. Geometries are streamed in the geojson format stored in radios
+    collection, without building the radios geodataframe.
+
+    :param db: mongo database connection
+    :param batch_size: number of radios read in each round trip
+    :return: generator of dicts with COD_2010_1 and geometry (geojson)
+    """
+    db[collection_destination_name].create_index('COD_2010_1')
+    db[_done_collection_name(collection_destination_name)].create_index('COD_2010_1')
+    cursor = db[radioscollection].aggregate(_pendinggeometries_pipeline(collection_destination_name),
+                                            batchSize=batch_size, allowDiskUse=True)
+    for doc in cursor:
+        yield {'COD_2010_1': doc['COD_2010_1'], 'geometry': doc['geometry']}
 
 
+def count_pendinggeometries(db, collection_destination_name, radioscollection='radios'):
+    """Number of radios neither stored in the destination collection nor marked as done"""
+    pipeline = _pendinggeometries_pipeline(collection_destination_name)[:-1] + [{'$count': 'pending'}]
+    result = list(db[radioscollection].aggregate(pipeline, allowDiskUse=True))
+    return result[0]['pending'] if len(result) > 0 else 0
 
 
 def  count_tweets_by_residents_and_timefreq(db, geometry, freq='Q'):
@@ -120,12 +170,12 @@ def  count_tweets_by_residents_and_timefreq(db, geometry, freq='Q'):
     """
 
     #Find users in radio and convert to df
-    usersinradio = db.users.find({'location': {'$geoWithin': {'$geometry': geometry}}})
-    usersinradio_df = pd.DataFrame(list(usersinradio))
+    usersinradio_df = dataaccess.read_columns(db.users, {'location': {'$geoWithin': {'$geometry': geometry}}},
+                                              {'u_id': 'u_id'})
 
     #Find tweets in radio and convert to df
-    tweetsinradio = db.tweets2.find({'location': {'$geoWithin': {'$geometry': geometry}}})
-    tweetsinradio = pd.DataFrame(list(tweetsinradio))
+    tweetsinradio = dataaccess.read_columns(db.tweets2, {'location': {'$geoWithin': {'$geometry': geometry}}},
+                                            {'u_id': 'u_id', 'created_at': 'created_at'})
 
     #chequeo que haya tweets en el radio
     if tweetsinradio.shape[0]>0:
@@ -160,6 +210,31 @@ def  count_tweets_by_residents_and_timefreq(db, geometry, freq='Q'):
 
 
 
+def count_tweets_by_residents_and_timefreq_long(db, geometry, freq='Q'):
+
+    """Same counts as count_tweets_by_residents_and_timefreq, in long format. To be used with counterjob
+
+    :param geometry: geometry in geojson format
+    :param freq: frequency of aggregation
+    :param db: mongo database connection
+
+    :return: dataframe with period, group and count
+
+    """
+    residents = dataaccess.user_ids(db, {'location': {'$geoWithin': {'$geometry': geometry}}})
+
+    tweetsinradio = dataaccess.read_columns(db.tweets2, {'location': {'$geoWithin': {'$geometry': geometry}}},
+                                            {'u_id': 'u_id', 'created_at': 'created_at'})
+
+    userlivesinradio = tweetsinradio['u_id'].isin(residents)
+    return pd.concat([timebasedcounts(tweetsinradio, 'totalcounts', frequency=freq),
+                      timebasedcounts(tweetsinradio.loc[userlivesinradio], 'residents', frequency=freq),
+                      timebasedcounts(tweetsinradio.loc[~userlivesinradio], 'nonresidents', frequency=freq)],
+                     ignore_index=True)
+
+
+
+
 def count_users(db, geometry, freq='Q'):
 
     """Process to obtain counts of users by censal radius
@@ -187,24 +262,28 @@ def timebasedaggregation(df3, name, frequency='Q'):
 
     :return Json """
 
-    if  df3['created_at'].dtype == '<M8[ns]': # if data is already timestamped then just copy
-        df3['timestamp'] =df3['created_at']
-    else:
-        df3['timestamp'] = pd.to_datetime(df3['created_at'] // 1000, unit='s')
-
-    df3['date'] = df3['timestamp'].dt.date
-    df3['hour'] = df3['timestamp'].dt.hour
-    df3.index = df3['timestamp']
+    timestamp = home.created_at_to_datetime(df3['created_at']).to_numpy()
 
-    df4=pd.DataFrame(df3['timestamp'].resample(frequency).count())
-    df4=df4.rename(columns={'timestamp':name})
+    df4=pd.DataFrame(pd.Series(timestamp, index=timestamp).resample(frequency).count())
+    df4=df4.rename(columns={0:name})
     df4.index=df4.index.rename('hola')
     return df4.to_json()
 
 
+def timebasedcounts(df, name, frequency='Q'):
+    """Timestamp based counts in long format. Same counts as timebasedaggregation, without json
 
+    :return dataframe with period (label in milliseconds since epoch), group (name) and count """
 
-def counterjob(db, sizeofchunk=20, methodtorun=count_tweets_by_residents_and_timefreq, destination_collection_name='radiocounts'):
+    counts = counts_by_area_and_period(pd.DataFrame({'area': 0, 'created_at': df['created_at'].to_numpy()}),
+                                       areacol='area', groups=['totalcounts'], freq=frequency)
+    return counts.assign(group=name)[['period', 'group', 'count']]
+
+
+
+
+def counterjob(db, sizeofchunk=20, methodtorun=count_tweets_by_residents_and_timefreq, destination_collection_name='radiocounts',
+               metrics=None):
 
     """This function administers the implementation of methods at the geometry level. Checks which geometries are pending, and writes the resutls with chunks.
     This version proceeds in order using the iterator
@@ -212,77 +291,243 @@ def counterjob(db, sizeofchunk=20, methodtorun=count_tweets_by_residents_and_tim
     :param db: mongo database connection
     :param methodtorun: algorithm to apply to the given geometry
     :param sizeofchunk: population is done with insert_many
+    :param metrics: optional instrumentation.JobMetrics. Times read (pending geometries), count and write stages
 
     :return
 
     """
 
-    starttime=time.time()
+    if metrics is None:
+        metrics = JobMetrics('counterjob', unit='geometries')
     # the following creates an iterator of the geometries that were not already processed and stored in collection destination_collection_name
-    pendingradiositerator = iteratorofpendinggeometries(db, destination_collection_name)
+    # (read from the database as they are needed)
+    pendingradiositerator = pendinggeometries(db, destination_collection_name)
+    if metrics.total is None:
+        metrics.total = count_pendinggeometries(db, destination_collection_name)
     therearependingjobs=True
-    jobtimes=[]
     while therearependingjobs:
         sizeofchunk=sizeofchunk
-        startjobtime=time.time()
         listofjobresults=[]
+        emptycodes=[]
+        ngeometries=0
         for i in range(sizeofchunk):
-            try: nextinlineradio=next(pendingradiositerator)
-            except StopIteration:
-                therearependingjobs=False
+            with metrics.stage('read'):
+                try: nextinlineradio=next(pendingradiositerator)
+                except StopIteration:
+                    therearependingjobs=False
+                    nextinlineradio=None
+            if nextinlineradio is None:
                 break
-            countresultsdict=json.loads(methodtorun(db, nextinlineradio['geometry']))
-            countresultsdict.update({'COD_2010_1' : nextinlineradio['COD_2010_1']})
-            listofjobresults.append(countresultsdict)
-        db[destination_collection_name].insert_many(listofjobresults)
-        jobtimes.append(time.time()-startjobtime)
-        print("job time:",time.time()-startjobtime)
+            with metrics.stage('count'):
+                result=methodtorun(db, nextinlineradio['geometry'])
+                documents=geometry_results_to_documents(nextinlineradio, result)
+                listofjobresults.extend(documents)
+                if len(documents)==0:
+                    emptycodes.append(nextinlineradio['COD_2010_1'])
+            ngeometries+=1
+        if len(listofjobresults)>0 or len(emptycodes)>0:
+            with metrics.stage('write'):
+                insert_geometry_results(db, destination_collection_name, listofjobresults, emptycodes)
+            metrics.count('documents', len(listofjobresults))
+        metrics.progress(ngeometries)
+
+    metrics.close()
+
+
+
+def geometry_results_to_documents(radio, result):
+    """Documents to store with the result of a counterjob method for a radio (json or long format counts)"""
+    if isinstance(result, pd.DataFrame): # long format counts, one record per period and group
+        return longcounts_to_records(result.assign(area=radio['COD_2010_1']), areafield='COD_2010_1')
+    countresultsdict=json.loads(result)
+    countresultsdict.update({'COD_2010_1' : radio['COD_2010_1']})
+    return [countresultsdict]
+
+
+def insert_geometry_results(db, collection_destination_name, documents, emptycodes):
+    """Writes the results of a batch of geometries.
+    Radios without tweets have no long format records, so their codes (emptycodes) are inserted in the
+    <collection_destination_name>_done collection instead. Otherwise they would be pending forever.
+    """
+    if len(documents) > 0:
+        db[collection_destination_name].insert_many(documents)
+    if len(emptycodes) > 0:
+        db[_done_collection_name(collection_destination_name)].insert_many(
+            [{'COD_2010_1': code} for code in emptycodes])
 
-    endtime = time.time()
-    print('total elapsed time ',endtime-starttime)
 
+def _timed(func, *args):
+    "Runs func in a worker thread and returns its result with the elapsed time"
+    starttime = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - starttime
 
 
-def tweets_in_hex_df(db, hexid, resolution='9'):
+def counterjob_concurrent(db, nthreads=8, maxinflight=None, sizeofchunk=100,
+                          methodtorun=count_tweets_by_residents_and_timefreq, destination_collection_name='radiocounts',
+                          metrics=None):
+
+    """Concurrent version of counterjob.
+    Counting a radio is mostly waiting on mongo queries, so up to maxinflight geometries are counted at the same time
+    by a pool of nthreads threads (pymongo clients are thread safe). Pending geometries are taken from the iterator
+    only when a slot is free, so the fan-out is bounded. Results are collected in completion order and written with
+    insert_many in batches of sizeofchunk documents by a separate writer thread, with at most one batch being written
+    while the next one is collected.
+
+    As in counterjob, the job is resumable: geometries already in destination_collection_name (or marked as done,
+    see insert_geometry_results) are skipped.
+
+    :param db: mongo database connection
+    :param nthreads: number of threads running methodtorun
+    :param maxinflight: maximum number of geometries being counted. Default is 2 * nthreads
+    :param sizeofchunk: number of documents of each insert_many
+    :param methodtorun: algorithm to apply to the given geometry
+    :param metrics: optional instrumentation.JobMetrics. count and write stages are measured in the worker threads,
+                    wait is the time spent waiting for results
+
     """
-    resolution:  9 or 10 in string """
+    if metrics is None:
+        metrics = JobMetrics('counterjob_concurrent', unit='geometries')
+    if maxinflight is None:
+        maxinflight = 2 * nthreads
+    # each counting thread and the writer hold a connection while they wait on mongo
+    maxpoolsize = commu.pool_size(db)
+    if maxpoolsize is not None and maxpoolsize < nthreads + 1:
+        print('Warning: connection pool of', maxpoolsize, 'for', nthreads, 'threads.',
+              'Use communicationwmongo.connecttoLocaldb(maxPoolSize=...)')
+
+    pendingradiositerator = pendinggeometries(db, destination_collection_name)
+    if metrics.total is None:
+        metrics.total = count_pendinggeometries(db, destination_collection_name)
+    def finishwrites(writes):
+        for write in writes:
+            metrics.observe('write', write.result()[1])
+
+    inflight = {}
+    listofjobresults = []
+    emptycodes = []
+    ngeometries = 0
+    pendingwrites = set()
+    therearependingjobs = True
+    with ThreadPoolExecutor(max_workers=nthreads) as counters, ThreadPoolExecutor(max_workers=1) as writer:
+        while True:
+            # fan-out: keep maxinflight geometries being counted
+            while therearependingjobs and len(inflight) < maxinflight:
+                try: nextinlineradio = next(pendingradiositerator)
+                except StopIteration:
+                    therearependingjobs = False
+                    break
+                inflight[counters.submit(_timed, methodtorun, db, nextinlineradio['geometry'])] = nextinlineradio
+            if len(inflight) == 0:
+                break
 
-    hexfieldname_indb = 'hex.' + resolution
-    columnname_indataframe = 'hex' + resolution
+            with metrics.stage('wait'):
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                result, seconds = future.result()
+                metrics.observe('count', seconds)
+                radio = inflight.pop(future)
+                documents = geometry_results_to_documents(radio, result)
+                listofjobresults.extend(documents)
+                if len(documents) == 0:
+                    emptycodes.append(radio['COD_2010_1'])
+                ngeometries += 1
+
+            if len(listofjobresults) + len(emptycodes) >= sizeofchunk:
+                # backpressure: waits for the previous batch before sending the next one
+                finishwrites(pendingwrites)
+                pendingwrites = {writer.submit(_timed, insert_geometry_results, db, destination_collection_name,
+                                               listofjobresults, emptycodes)}
+                metrics.count('documents', len(listofjobresults))
+                listofjobresults = []
+                emptycodes = []
+                metrics.progress(ngeometries)
+                ngeometries = 0
+
+        finishwrites(pendingwrites)
+        if len(listofjobresults) > 0 or len(emptycodes) > 0:
+            finishwrites([writer.submit(_timed, insert_geometry_results, db, destination_collection_name,
+                                        listofjobresults, emptycodes)])
+            metrics.count('documents', len(listofjobresults))
+        metrics.progress(ngeometries)
+
+    metrics.close()
+
+
+def count_tweets_by_residents_and_timefreq_all(db, radiohexs=None, freq='Q', destination_collection_name='radiocounts'):
+
+    """Same counts as counterjob with count_tweets_by_residents_and_timefreq, for all pending radios at once.
+    Tweets and users locations are assigned to radios with the radio to hexagon index in a single scan,
+    instead of $geoWithin queries for each radio.
+
+    :param radiohexs: radio to hexagon index at resolution 10. Built with my_h3_functions.polygons_hex_index if not given
+    :param freq: frequency of aggregation
 
-    tweets_in_hex_cursor = db.tweets.find({hexfieldname_indb: hexid})
+    """
+    starttime=time.time()
+    groups=['totalcounts', 'residents', 'nonresidents']
+
+    radiosgdf=commu.radios_gdf_from_db(db)
+    if radiohexs is None:
+        radiohexs=myh3.polygons_hex_index(radiosgdf, codecol='COD_2010_1', hexresolution=10)
+    polygons=dict(zip(radiosgdf['COD_2010_1'], radiosgdf.geometry))
+
+    tweets=commu.tweets_to_radios(db, radiosgdf, radiohexs, collectionname='tweets2', resolution='10')
+    tweets=tweets.loc[tweets['code'].notna()]
+
+    users=list(db.users.find({'location': {'$exists': True}}, {'_id': 0, 'u_id': 1, 'location.coordinates': 1}))
+    userscodes=myh3.points_to_polygons_with_hexindex([doc['location']['coordinates'][0] for doc in users],
+                                                     [doc['location']['coordinates'][1] for doc in users],
+                                                     radiohexs, polygons, hexresolution=10)
+    tweets['home']=tweets['u_id'].map(pd.Series(userscodes, index=[doc['u_id'] for doc in users]))
+    tweets['residents']=(tweets['home']==tweets['code']).to_numpy()
+    tweets['nonresidents']=~tweets['residents']
+
+    documents=longcounts_to_documents(counts_by_area_and_period(tweets, areacol='code', groups=groups, freq=freq),
+                                      groups=groups)
+
+    completed=set(db[destination_collection_name].distinct('COD_2010_1'))
+    listofjobresults=[dict(documents.get(code, {group: {} for group in groups}), COD_2010_1=code)
+                      for code in radiosgdf['COD_2010_1'] if code not in completed]
+    if len(listofjobresults)>0:
+        db[destination_collection_name].insert_many(listofjobresults)
+
+    print('radios processed:', len(listofjobresults), 'total elapsed time ', time.time()-starttime)
 
-    tweets_in_hex_df = pd.DataFrame(list(tweets_in_hex_cursor))
 
-    # extract the hex9 data in the json into a new column
-    tweets_in_hex_df = pd.concat([tweets_in_hex_df,
-                                  tweets_in_hex_df.apply(lambda x: x['hex'][resolution], axis=1).rename(
-                                      columnname_indataframe)], axis=1)
+def tweets_in_hex_df(db, hexid, resolution='9'):
+    """
+    resolution:  9 or 10 in string
+    hexid: string or 64 bits integer """
 
-    return tweets_in_hex_df
+    # u_id, created_at and hex<resolution> columns
+    return dataaccess.hex_tweets(db, hexid, resolution=resolution)
 
 
-def users_in_hex_list(db, hexid, resolution='9'):
+def users_in_hex_list(db, hexid, resolution='9', index=None):
     """
-    resolution:  9 or 10 in string """
+    resolution:  9 or 10 in string
+    index: optional home_index.HomeIndex, used instead of querying users collection
+    hexid: string or 64 bits integer """
 
-    hexfieldname_indb = 'hex' + resolution + "." + 'hex' + resolution
-    users_in_hex_cursor = db.users.find({hexfieldname_indb: hexid})
-    users_in_hex_df = pd.DataFrame(list(users_in_hex_cursor))
-    try:
-        users_in_hex_list = list(users_in_hex_df['u_id'])
-    except KeyError:
-        users_in_hex_list =[] #returns empty
+    if index is not None:
+        return index.users_in_hex(myh3.hex_to_str(hexid)).tolist()
 
-    return users_in_hex_list
+    hexfieldname_indb = 'hex' + resolution + "." + 'hex' + resolution
+    return dataaccess.user_ids(db, {hexfieldname_indb: dataaccess.hex_query(hexid)}).tolist()
 
 
-def users_in_hex_plus_neighbors_list(db, hexid, contiguity=1, resolution='9'):
+def users_in_hex_plus_neighbors_list(db, hexid, contiguity=1, resolution='9', index=None):
     """Adding neigbors of specified contiguity using h3 ring functions
+    index: optional home_index.HomeIndex, used instead of querying users collection
 
     # comment> Shouldnt be necessary to specify resolution once hexid is given> check h3 documentation to obtain resoltuion on the basis of hexid
     """
 
+    hexid = myh3.hex_to_str(hexid)
+    if index is not None:
+        return index.users_in_hex_plus_neighbors(hexid, contiguity=contiguity).tolist()
+
     neighboring_hex_list = list(h3.k_ring_distances(hexid, ring_size=contiguity)[contiguity])
 
     # funcion para graficar los poligonos
@@ -297,24 +542,15 @@ def users_in_hex_plus_neighbors_list(db, hexid, contiguity=1, resolution='9'):
 
     hexfieldname_indb = 'hex' + resolution + "." + 'hex' + resolution
 
-    for n_hexid in neighboring_hex_list:
-
-        users_in_n_hex_cursor = db.users.find({hexfieldname_indb: n_hexid})
-        users_in_n_hex_df = pd.DataFrame(list(users_in_n_hex_cursor))
-
-        try:
-            users_in_n_hex_list = list(users_in_n_hex_df['u_id'])
-        except KeyError:
-            pass
-        else:
-            users_in_hex_plus_neighbors_list.extend(users_in_n_hex_list)
+    # users living in the neighbors, with a single query
+    users_in_hex_plus_neighbors_list.extend(dataaccess.user_ids(db, {hexfieldname_indb: dataaccess.hex_query(neighboring_hex_list)}).tolist())
     return users_in_hex_plus_neighbors_list
 
 
-def tweets_from_hex_residents(db, hexid, resolution='9'):
+def tweets_from_hex_residents(db, hexid, resolution='9', index=None):
     tweets_in_hex_df2 = tweets_in_hex_df(db, hexid, resolution=resolution)
 
-    users_in_hex_list2 = users_in_hex_list(db, hexid, resolution=resolution)
+    users_in_hex_list2 = users_in_hex_list(db, hexid, resolution=resolution, index=index)
 
     # queda pendiente separar los tweets de los residentes:
     # tweets de residentes
@@ -323,10 +559,10 @@ def tweets_from_hex_residents(db, hexid, resolution='9'):
     return tweets_from_residents
 
 
-def tweets_from_hex_non_residents(db, hexid, resolution='9'):
+def tweets_from_hex_non_residents(db, hexid, resolution='9', index=None):
     tweets_in_hex_df2 = tweets_in_hex_df(db, hexid, resolution=resolution)
 
-    users_in_hex_list2 = users_in_hex_list(db, hexid, resolution=resolution)
+    users_in_hex_list2 = users_in_hex_list(db, hexid, resolution=resolution, index=index)
 
     # tweets de no residentes
     tweets_from_non_residents = tweets_in_hex_df2[~tweets_in_hex_df2['u_id'].isin(users_in_hex_list2)]
@@ -334,12 +570,11 @@ def tweets_from_hex_non_residents(db, hexid, resolution='9'):
     return tweets_from_non_residents
 
 
-def tweets_from_non_residents_and_non_neighbors(db, hexid, contiguity=1, resolution='9'):
+def tweets_from_non_residents_and_non_neighbors(db, hexid, contiguity=1, resolution='9', index=None):
     tweets_in_hex_df2 = tweets_in_hex_df(db, hexid, resolution=resolution)
 
-    users_in_hex_list2 = users_in_hex_list(db, hexid, resolution=resolution)
-
-    users_in_hex_plus_neighbors_list2 = users_in_hex_plus_neighbors_list(db, hexid, contiguity=1, resolution='9',db=db)
+    users_in_hex_plus_neighbors_list2 = users_in_hex_plus_neighbors_list(db, hexid, contiguity=contiguity,
+                                                                          resolution='9', index=index)
 
     # tweets de no residentes y no vecinos
     tweets_from_non_residents_and_non_neighbors = tweets_in_hex_df2[
@@ -350,7 +585,7 @@ def tweets_from_non_residents_and_non_neighbors(db, hexid, contiguity=1, resolut
 
 
 
-def countsby_residents_and_non_residents(db, hexid, contiguity=1, resolution='9', freq='Q'):
+def countsby_residents_and_non_residents(db, hexid, contiguity=1, resolution='9', freq='Q', index=None):
     """
     Counts by residents and non residents.
 
@@ -360,14 +595,16 @@ def countsby_residents_and_non_residents(db, hexid, contiguity=1, resolution='9'
     :param contiguity:
     :param resolution:
     :param freq:
+    :param index: optional home_index.HomeIndex, used instead of querying users collection
     :return: json of counts
 
     """
     tweets_in_hex_df2 = tweets_in_hex_df(db, hexid, resolution=resolution)
 
-    users_in_hex_list2 = users_in_hex_list(db, hexid, resolution=resolution)
+    users_in_hex_list2 = users_in_hex_list(db, hexid, resolution=resolution, index=index)
 
-    users_in_hex_plus_neighbors_list2 = users_in_hex_plus_neighbors_list(db, hexid, contiguity=contiguity, resolution='9')
+    users_in_hex_plus_neighbors_list2 = users_in_hex_plus_neighbors_list(db, hexid, contiguity=contiguity, resolution='9',
+                                                                          index=index)
 
     if tweets_in_hex_df2.shape[0] > 0:
 
@@ -443,41 +680,491 @@ def countandpopulatejobDEPRECATED(db):
         db.hexcounts.update_one({'_id': hexid}, {'$set': json.loads(result)}, upsert=False)
 
 
-def countandpopulatejob(db):
+def countandpopulatejob(db, index=None, metrics=None):
 
     """
     Simple job to implement countsby_residents_and_non_residents
     and populate into hexcounts collection
 
+    :param index: optional home_index.HomeIndex, used instead of querying users collection for each hexagon
+    :param metrics: optional instrumentation.JobMetrics. Times read (pending hexagons), count and write stages
+
     """
     numberof_hexcounts_without_totalcounts=db.hexcounts.count_documents({'totalcounts': { '$exists': False} })
-    print('Hexagons pending to analyze..', numberof_hexcounts_without_totalcounts)
+    if metrics is None:
+        metrics = JobMetrics('countandpopulatejob', total=numberof_hexcounts_without_totalcounts, unit='hexagons')
 
     while numberof_hexcounts_without_totalcounts>0:
 
         cursorx = db.hexcounts.find({'totalcounts': {'$exists': False}},batch_size=10, limit=5)
 
-        continuar = 1
-        j=1
-        while continuar == 1:
-            try:
-                hexid = next(cursorx)['_id']
-                print(hexid)
-                if (j/50).is_integer(): #printing each 50 hexs
-                    print('iter:',j)
-                j=j+1
-
-            except StopIteration:
-                print('fin')
-                break
+        j=0
+        while True:
+            with metrics.stage('read'):
+                try:
+                    hexid = next(cursorx)['_id']
+                except StopIteration:
+                    break
 
-            result = countsby_residents_and_non_residents(db, hexid, contiguity=1, resolution='9', freq='Q')
+            with metrics.stage('count'):
+                result = countsby_residents_and_non_residents(db, hexid, contiguity=1, resolution='9', freq='Q', index=index)
             #print(result)
-            db.hexcounts.update_one({'_id': hexid}, {'$set': json.loads(result)}, upsert=False)
+            with metrics.stage('write'):
+                db.hexcounts.update_one({'_id': hexid}, {'$set': json.loads(result)}, upsert=False)
+            j=j+1
+
+        with metrics.stage('read'):
+            numberof_hexcounts_without_totalcounts=db.hexcounts.count_documents({'totalcounts': { '$exists': False} })
+        metrics.progress(j, pending=numberof_hexcounts_without_totalcounts)
+
+    metrics.close()
+
+########## Counts for all hexagons at once
+# Same counts as countsby_residents_and_non_residents, but tweets are joined to users home hexagon in a single
+# columnar join, and all hexagons and periods are counted together
+
+COUNTGROUPS = ['totalcounts', 'residents', 'nonresidents', 'nonresidentsandnonneighbors']
+
+
+def homes_series(db, resolution='9', index=None):
+    """
+    Home hexagon of each user with a home
+    index: optional home_index.HomeIndex, used instead of reading users collection
+
+    :return: series of home hexagons indexed by u_id
+    """
+    if index is not None:
+        withhome = index.homes > 0
+        return pd.Series(myh3.int_to_hexs(index.homes[withhome]), index=index.uids[withhome])
+
+    users = dataaccess.user_homes(db, resolution=resolution)
+    return pd.Series(users['hex' + resolution].to_numpy(), index=users['u_id'].to_numpy(), dtype=object)
+
+
+def tweets_and_homes_df(db, resolution='9', index=None, query=None, homes=None):
+    """
+    Reads tweets hexagon, user and date, joined with the home hexagon of each user (NaN if home was not found)
+    index: optional home_index.HomeIndex, used instead of reading users collection
+    query: optional filter of tweets (default all tweets)
+    homes: optional series of home hexagons indexed by u_id (see homes_series), used instead of index or users
+
+    :return: dataframe with u_id, hex, created_at and home columns
+    """
+    tweets = dataaccess.tweets_with_hex(db, query=query, resolution=resolution)
+
+    if homes is None and index is not None:
+        homes = index.home_of(tweets['u_id'])
+        tweets['home'] = np.where(homes > 0, myh3.int_to_hexs(homes), np.nan)
+        return tweets
+
+    if homes is None:
+        homes = homes_series(db, resolution=resolution)
+
+    tweets['home'] = tweets['u_id'].map(homes)
+    return tweets
+
+
+def classify_residents(tweets, contiguity=1):
+    """
+    Adds residents, nonresidents and nonresidentsandnonneighbors dummies to tweets with hex and home columns
+    Neighbors are users living in the ring of hexagons at distance contiguity, as in users_in_hex_plus_neighbors_list
+    """
+    tweets['residents'] = (tweets['home'] == tweets['hex']).to_numpy()
+    tweets['nonresidents'] = ~tweets['residents']
+
+    # table of hexagons considered neighbors of each home hexagon (including itself)
+    homes = tweets['home'].dropna().unique()
+    neighbors = pd.DataFrame([(home, hexid) for home in homes
+                              for hexid in [home] + list(h3.k_ring_distances(home, contiguity)[contiguity])],
+                             columns=['home', 'hex'])
+    neighbors['neighbor'] = True
+
+    isneighbor = tweets[['home', 'hex']].astype(object).merge(neighbors, on=['home', 'hex'], how='left')['neighbor']
+    tweets['nonresidentsandnonneighbors'] = isneighbor.isna().to_numpy()
+    return tweets
+
+
+def period_labels_in_ms(ordinals, freq='Q'):
+    """Labels of periods in milliseconds since epoch, as in timebasedaggregation json keys (resample labels the
+    period by its last day)"""
+    return {ordinal: int(pd.Period(ordinal=ordinal, freq=freq).end_time.normalize().value // 10**6)
+            for ordinal in np.unique(ordinals)}
+
+
+def counts_by_area_and_period(tweets, areacol='hex', groups=COUNTGROUPS, freq='Q', weights=None):
+    """
+    Counts tweets by area, period and group, for all areas at once
+
+    Periods between the first and the last period with tweets of each area and group are filled with zeros, as
+    timebasedaggregation does with resample.
+
+    :param tweets: dataframe of tweets with areacol, created_at and a boolean column for each group (except totalcounts)
+    :param groups: list of groups. totalcounts includes all tweets
+    :param weights: optional column with the number of tweets in each row (default one tweet per row)
+    :return: long format dataframe with area, period (label in milliseconds since epoch), group and count
+    """
+    ordinals = pd.Series(pd.PeriodIndex(home.created_at_to_datetime(tweets['created_at']), freq=freq).asi8, index=tweets.index)
+
+    listofcounts = []
+    for group in groups:
+        mask = np.ones(tweets.shape[0], dtype=bool) if group == 'totalcounts' else tweets[group].to_numpy(dtype=bool)
+        counts = pd.DataFrame({'area': tweets[areacol].to_numpy()[mask], 'ordinal': ordinals.to_numpy()[mask]})
+        if weights is None:
+            counts = counts.groupby(['area', 'ordinal']).size().rename('count').reset_index()
+        else:
+            counts['count'] = tweets[weights].to_numpy()[mask]
+            counts = counts.groupby(['area', 'ordinal'])['count'].sum().reset_index()
+        if counts.shape[0] == 0:
+            continue
+
+        # all periods between first and last period of each area
+        bounds = counts.groupby('area')['ordinal'].agg(['min', 'max'])
+        lengths = (bounds['max'] - bounds['min'] + 1).to_numpy()
+        starts = np.repeat(bounds['min'].to_numpy(), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        allperiods = pd.DataFrame({'area': np.repeat(bounds.index.to_numpy(), lengths), 'ordinal': starts + offsets})
+
+        counts = allperiods.merge(counts, on=['area', 'ordinal'], how='left').fillna({'count': 0})
+        counts['group'] = group
+        listofcounts.append(counts)
+
+    if len(listofcounts) == 0:
+        return pd.DataFrame(columns=['area', 'period', 'group', 'count'])
+
+    counts = pd.concat(listofcounts, ignore_index=True)
+    counts['period'] = counts['ordinal'].map(period_labels_in_ms(counts['ordinal'], freq=freq))
+    counts['count'] = counts['count'].astype(np.int64)
+    return counts[['area', 'period', 'group', 'count']]
+
+
+def longcounts_to_documents(counts, groups=COUNTGROUPS):
+    """
+    Converts long format counts to the nested documents written by countandpopulatejob
+    ({'totalcounts': {period in ms: count}, 'residents': {...}, ...})
+
+    :return: dict of documents by area
+    """
+    documents = {area: {group: {} for group in groups} for area in counts['area'].unique()}
+    for area, period, group, count in zip(counts['area'], counts['period'], counts['group'], counts['count']):
+        documents[area][group][str(period)] = int(count)
+    return documents
+
+
+def longcounts_to_records(counts, areafield='area'):
+    """Long format counts as records for insert_many (native python types)"""
+    return [{areafield: area, 'period': int(period), 'group': group, 'count': int(count)}
+            for area, period, group, count in zip(counts['area'], counts['period'], counts['group'], counts['count'])]
+
+
+def insert_longcounts(db, counts, collectionname, areafield='area', sizeofchunk=10000):
+    """Inserts long format counts in collectionname, one record per area, period and group"""
+    records = longcounts_to_records(counts, areafield=areafield)
+    for i in range(0, len(records), sizeofchunk):
+        db[collectionname].insert_many(records[i:i+sizeofchunk], ordered=False)
+    db[collectionname].create_index([(areafield, 1), ('period', 1), ('group', 1)], unique=True)
+
+
+def longcounts_to_panel(counts, groups=COUNTGROUPS, areafield='area'):
+    """
+    Rebuilds the hex (or radio) and time panel from long format counts. Same columns as hexcountsresults_to_df,
+    except that the period label (milliseconds since epoch) is in period instead of level_1
+
+    :return: dataframe with _id, period, time and a column for each group
+    """
+    panel = counts.groupby([areafield, 'period', 'group'])['count'].sum().unstack('group')
+    panel = panel.reindex(columns=groups).reset_index().rename(columns={areafield: '_id'})
+    panel.columns.name = None
+    panel['time'] = pd.to_datetime(panel['period'] // 1000, unit='s')
+    return panel
+
+
+def hexcountslong_to_df(db, collectionname='hexcounts_long', areafield='area', save=False):
+
+    """ Converts a long format counts collection (see countandpopulatejob_all) to the panel dataframe"""
+
+    docs = list(db[collectionname].find({}, {'_id': 0, areafield: 1, 'period': 1, 'group': 1, 'count': 1}))
+    counts = pd.DataFrame({areafield: [doc[areafield] for doc in docs],
+                           'period': np.array([doc['period'] for doc in docs], dtype=np.int64),
+                           'group': [doc['group'] for doc in docs],
+                           'count': np.array([doc['count'] for doc in docs], dtype=np.int64)})
+    df = longcounts_to_panel(counts, areafield=areafield)
+
+    if save:
+        df.to_pickle("./hexcountsdf.pkl")
+
+    return df
+
+
+def countandpopulatejob_all(db, contiguity=1, freq='Q', sizeofchunk=1000, index=None, outputformat='documents'):
+
+    """
+    Implements countsby_residents_and_non_residents for all hexagons at once
+    and populates results into hexcounts collection with bulk writes
+
+    :param contiguity: neighbors ring
+    :param freq: frequency of aggregation
+    :param sizeofchunk: number of documents in each bulk write
+    :param index: optional home_index.HomeIndex, used instead of reading users collection
+    :param outputformat: 'documents' writes nested documents in hexcounts, 'long' replaces hexcounts_long collection
+                         with one record per hexagon, period and group (see hexcountslong_to_df)
+    """
+    starttime=time.time()
+
+    tweets=classify_residents(tweets_and_homes_df(db, resolution='9', index=index), contiguity=contiguity)
+    print('tweets read and joined to homes', tweets.shape[0], 'time:', time.time()-starttime)
+
+    counts=counts_by_area_and_period(tweets, areacol='hex', freq=freq)
+    print('hexagons counted', counts['area'].nunique(), 'time:', time.time()-starttime)
+
+    if outputformat=='long':
+        db.hexcounts_long.delete_many({})
+        insert_longcounts(db, counts, 'hexcounts_long', sizeofchunk=sizeofchunk)
+        print('total elapsed time ', time.time()-starttime)
+        return
+
+    documents=longcounts_to_documents(counts)
+
+    requests=[UpdateOne({'_id': hexid}, {'$set': document}, upsert=True) for hexid, document in documents.items()]
+    for i in range(0, len(requests), sizeofchunk):
+        try:
+            db.hexcounts.bulk_write(requests[i:i+sizeofchunk], ordered=False)
+        except BulkWriteError as bwe:
+            print(bwe.details)
+
+    print('total elapsed time ', time.time()-starttime)
+
+
+def _inc_longcounts(db, counts, collectionname, sizeofchunk=1000):
+    """Adds long format counts to the counts already stored in collectionname ($inc, creating missing records)"""
+    listofupdates = [UpdateOne({'area': area, 'period': int(period), 'group': group},
+                               {'$inc': {'count': int(count)}}, upsert=True)
+                     for area, period, group, count in zip(counts['area'], counts['period'], counts['group'], counts['count'])]
+    for i in range(0, len(listofupdates), sizeofchunk):
+        db[collectionname].bulk_write(listofupdates[i:i + sizeofchunk], ordered=False)
+
+
+def _zerofill_longcounts(db, collectionname, areas, freq='Q', sizeofchunk=1000):
+    """
+    Leaves the records of areas as countandpopulatejob_all writes them: zeros for the periods between the first and the
+    last period with tweets of each area and group, and no records outside of them (periods added or emptied by $inc)
+    """
+    docs = list(db[collectionname].find({'area': {'$in': list(areas)}},
+                                        {'_id': 0, 'area': 1, 'period': 1, 'group': 1, 'count': 1}))
+    if len(docs) == 0:
+        return
+    stored = pd.DataFrame({'area': [doc['area'] for doc in docs],
+                           'created_at': np.array([doc['period'] for doc in docs], dtype=np.int64),
+                           'group': [doc['group'] for doc in docs],
+                           'count': np.array([doc['count'] for doc in docs], dtype=np.int64)})
+
+    # the stored counts, as weighted tweets, are counted again with the periods filled as in the full job
+    listofcounts = []
+    for group, groupcounts in stored.loc[stored['count'] != 0].groupby('group'):
+        listofcounts.append(counts_by_area_and_period(groupcounts.assign(**{group: True}), areacol='area',
+                                                      groups=[group], freq=freq, weights='count'))
+    keys = ['area', 'period', 'group']
+    stored = stored.rename(columns={'created_at': 'period'})
+    filled = pd.concat(listofcounts, ignore_index=True) if len(listofcounts) > 0 else stored.iloc[:0]
+    merged = stored[keys].merge(filled[keys], on=keys, how='outer', indicator=True)
+
+    listofupdates = [UpdateOne({'area': area, 'period': int(period), 'group': group}, {'$inc': {'count': 0}}, upsert=True)
+                     for area, period, group in merged.loc[merged['_merge'] == 'right_only', keys].to_numpy()]
+    listofupdates += [DeleteOne({'area': area, 'period': int(period), 'group': group})
+                      for area, period, group in merged.loc[merged['_merge'] == 'left_only', keys].to_numpy()]
+    for i in range(0, len(listofupdates), sizeofchunk):
+        db[collectionname].bulk_write(listofupdates[i:i + sizeofchunk], ordered=False)
+
+
+def countandpopulatejob_delta(db, contiguity=1, freq='Q', sizeofchunk=1000, index=None,
+                              collectionname='hexcounts_long', progresscollection='jobprogress'):
+
+    """
+    Incremental version of countandpopulatejob_all(outputformat='long')
+
+    Tweets are tracked with a high-water mark on _id (stored in progresscollection), so each run only reads the tweets
+    inserted since the previous run and adds them to their (hex, period, group) counts with $inc. Homes used in the
+    counts are stored in collectionname + '_homes'; previous tweets of users whose home changed are moved between
+    resident groups. The first run (or a run with different contiguity or freq) counts all tweets.
+
+    Before counts are written, the range of tweets being added is stored as pending in the progress document, and it is
+    removed (with the high-water mark advanced) only after all writes succeeded. Counts of a run that failed or was
+    interrupted in between are unknown, so the next run finds the pending range and counts all tweets again.
+
+    :param contiguity: neighbors ring
+    :param freq: frequency of aggregation
+    :param sizeofchunk: number of documents in each bulk write
+    :param index: optional home_index.HomeIndex, used instead of reading users collection
+    """
+    starttime = time.time()
+    homescollection = collectionname + '_homes'
+
+    last = db.tweets.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    if last is None:
+        print('no tweets to count')
+        return
+    highwatermark = last['_id']
+
+    progress = db[progresscollection].find_one({'_id': collectionname})
+    if progress is not None and progress.get('pending') is not None:
+        print('previous run did not finish updating counts of tweets', progress['pending'], 'counting all tweets')
+        progress = None
+    if progress is not None and (progress.get('contiguity'), progress.get('freq')) != (contiguity, freq):
+        print('contiguity or frequency changed, counting all tweets')
+        progress = None
+
+    homes = homes_series(db, index=index)
+    if progress is None:
+        lowwatermark = None
+        previoushomes = pd.Series(dtype=object)
+        query = {'_id': {'$lte': highwatermark}}
+    else:
+        lowwatermark = progress['highwatermark']
+        previous = list(db[homescollection].find({}, {'_id': 1, 'home': 1}))
+        previoushomes = pd.Series([doc['home'] for doc in previous], index=[doc['_id'] for doc in previous], dtype=object)
+        query = {'_id': {'$gt': lowwatermark, '$lte': highwatermark}}
+
+    # nuevos tweets, clasificados con los hogares actuales
+    newtweets = tweets_and_homes_df(db, query=query, homes=homes)
+    listofcounts = [counts_by_area_and_period(classify_residents(newtweets, contiguity), freq=freq)]
+    print('new tweets', newtweets.shape[0])
+
+    # users whose home changed (found, lost or moved) since the previous run
+    allusers = homes.index.union(previoushomes.index)
+    currenthome = homes.reindex(allusers)
+    previoushome = previoushomes.reindex(allusers)
+    samehome = (currenthome == previoushome) | (currenthome.isna() & previoushome.isna())
+    changed = allusers[~samehome.to_numpy()]
+    print('users with new home', len(changed))
+
+    if lowwatermark is not None and len(changed) > 0:
+        # previous tweets of these users: remove them from groups of the old home and add them to the new ones
+        residentgroups = [group for group in COUNTGROUPS if group != 'totalcounts']
+        oldtweets = tweets_and_homes_df(db, query={'_id': {'$lte': lowwatermark}, 'u_id': {'$in': [int(uid) for uid in changed]}},
+                                        homes=homes)
+        listofcounts.append(counts_by_area_and_period(classify_residents(oldtweets, contiguity), groups=residentgroups, freq=freq))
+
+        oldtweets['home'] = oldtweets['u_id'].map(previoushomes)
+        removed = counts_by_area_and_period(classify_residents(oldtweets, contiguity), groups=residentgroups, freq=freq)
+        removed['count'] = -removed['count']
+        listofcounts.append(removed)
+
+    counts = pd.concat(listofcounts, ignore_index=True).groupby(['area', 'period', 'group'])['count'].sum().reset_index()
+
+    # in-progress marker: stays in the progress document if any of the following writes fails
+    db[progresscollection].update_one({'_id': collectionname},
+                                      {'$set': {'pending': {'from': lowwatermark, 'to': highwatermark}}}, upsert=True)
+    if lowwatermark is None:
+        db[collectionname].delete_many({})
+        db[homescollection].delete_many({})
+        insert_longcounts(db, counts, collectionname, sizeofchunk=sizeofchunk)
+    else:
+        _inc_longcounts(db, counts, collectionname, sizeofchunk=sizeofchunk)
+        _zerofill_longcounts(db, collectionname, counts['area'].unique(), freq=freq, sizeofchunk=sizeofchunk)
+    print('records updated', counts.shape[0], 'time:', time.time() - starttime)
+
+    listofupdates = [UpdateOne({'_id': int(uid)}, {'$set': {'home': home}}, upsert=True) if isinstance(home, str)
+                     else DeleteOne({'_id': int(uid)})
+                     for uid, home in zip(changed, currenthome.reindex(changed))]
+    for i in range(0, len(listofupdates), sizeofchunk):
+        db[homescollection].bulk_write(listofupdates[i:i + sizeofchunk], ordered=False)
+
+    db[progresscollection].update_one({'_id': collectionname},
+                                      {'$set': {'highwatermark': highwatermark, 'contiguity': contiguity, 'freq': freq,
+                                                'updated': datetime.datetime.utcnow()},
+                                       '$unset': {'pending': ''}}, upsert=True)
+    print('total elapsed time ', time.time() - starttime)
+
+
+##########Hexagon pyramid
+# Tweets are counted once by (tweet hexagon, home hexagon, period) at the finest resolution. Counts at any coarser
+# resolution are rolled up from these pairs with parent hexagons, so residents (same parent hexagon) and neighbors
+# are classified again at each scale without reading the tweets.
+# Note: coarser hexagons are the h3 parents of the finest ones. H3 cells are not exactly nested, so near the edges a
+# parent can differ from the hexagon of the tweet point at that resolution (hex.9 field).
+
+def hex_pair_counts(tweets, freq='Q'):
+    """
+    Counts tweets by tweet hexagon, home hexagon of the user and period
+
+    :param tweets: dataframe with hex, home (NaN if the user has no home) and created_at columns
+    :return: dataframe with hex, home ('' for users without home), period (label in milliseconds since epoch) and count
+    """
+    ordinals = pd.PeriodIndex(home.created_at_to_datetime(tweets['created_at']), freq=freq).asi8
+    pairs = pd.DataFrame({'hex': tweets['hex'].to_numpy(), 'home': tweets['home'].fillna('').to_numpy(),
+                          'ordinal': ordinals})
+    pairs = pairs.groupby(['hex', 'home', 'ordinal']).size().rename('count').reset_index()
+    pairs['period'] = pairs['ordinal'].map(period_labels_in_ms(pairs['ordinal'], freq=freq))
+    return pairs[['hex', 'home', 'period', 'count']]
+
+
+def job_hexpaircounts(db, resolution='10', homeresolution='9', freq='Q', index=None, collectionname='hexpaircounts',
+                      sizeofchunk=10000):
+
+    """
+    Counts all tweets by (tweet hexagon, home hexagon, period) and replaces collectionname with the results
+
+    :param resolution: resolution of tweets hexagons, the finest resolution of the pyramid
+    :param homeresolution: resolution of home hexagons in users collection
+    :param index: optional home_index.HomeIndex, used instead of reading users collection
+    """
+    starttime = time.time()
+    homes = homes_series(db, resolution=homeresolution, index=index)
+    tweets = tweets_and_homes_df(db, resolution=resolution, homes=homes)
+    pairs = hex_pair_counts(tweets, freq=freq)
+    print('tweets', tweets.shape[0], 'pairs', pairs.shape[0], 'time:', time.time() - starttime)
+
+    records = [{'hex': hexid, 'home': homeid, 'period': int(period), 'count': int(count)}
+               for hexid, homeid, period, count in zip(pairs['hex'], pairs['home'], pairs['period'], pairs['count'])]
+    db[collectionname].delete_many({})
+    for i in range(0, len(records), sizeofchunk):
+        db[collectionname].insert_many(records[i:i + sizeofchunk], ordered=False)
+    db[collectionname].create_index([('hex', 1), ('home', 1), ('period', 1)], unique=True)
+    print('total elapsed time ', time.time() - starttime)
+
+
+def rollup_pair_counts(pairs, resolution, contiguity=1, freq='Q', groups=COUNTGROUPS):
+    """
+    Counts by hexagon, period and group at a coarser resolution, from pair counts (see hex_pair_counts)
+
+    :param resolution: resolution of the counts. Can not be finer than the resolution of tweets or homes hexagons
+    :param freq: frequency of aggregation. Same as (or coarser than) the frequency of the pair counts
+    :return: long format dataframe with area, period, group and count (as counts_by_area_and_period)
+    """
+    withhome = (pairs['home'] != '').to_numpy()
+    homes = np.full(pairs.shape[0], '', dtype=object)
+    homes[withhome] = myh3.hexs_to_parents(pairs['home'].to_numpy()[withhome], int(resolution))
+
+    tweets = pd.DataFrame({'hex': myh3.hexs_to_parents(pairs['hex'].to_numpy(), int(resolution)), 'home': homes,
+                           'created_at': pairs['period'].to_numpy(dtype=np.int64),
+                           'count': pairs['count'].to_numpy(dtype=np.int64)})
+    # users without home keep the '' label while grouping (groupby drops NaN keys), NaN afterwards
+    tweets = tweets.groupby(['hex', 'home', 'created_at'])['count'].sum().reset_index()
+    tweets['home'] = tweets['home'].where(tweets['home'] != '', np.nan)
+
+    tweets = classify_residents(tweets, contiguity)
+    return counts_by_area_and_period(tweets, groups=groups, freq=freq, weights='count')
+
+
+def hexcounts_at_resolution(db, resolution, contiguity=1, freq='Q', collectionname='hexpaircounts', populate=False):
+
+    """
+    Rolls up pair counts stored by job_hexpaircounts to a coarser resolution
+
+    :param populate: if True, replaces hexcounts_long_<resolution> collection with the results
+    :return: long format dataframe with area, period, group and count (see longcounts_to_panel)
+    """
+    docs = list(db[collectionname].find({}, {'_id': 0, 'hex': 1, 'home': 1, 'period': 1, 'count': 1}))
+    pairs = pd.DataFrame({'hex': [doc['hex'] for doc in docs], 'home': [doc['home'] for doc in docs],
+                          'period': np.array([doc['period'] for doc in docs], dtype=np.int64),
+                          'count': np.array([doc['count'] for doc in docs], dtype=np.int64)})
+    counts = rollup_pair_counts(pairs, resolution, contiguity=contiguity, freq=freq)
+
+    if populate:
+        db['hexcounts_long_' + str(resolution)].delete_many({})
+        insert_longcounts(db, counts, 'hexcounts_long_' + str(resolution))
 
+    return counts
 
-        numberof_hexcounts_without_totalcounts=db.hexcounts.count_documents({'totalcounts': { '$exists': False} })
-        print('Hexagons pending to analyze..', numberof_hexcounts_without_totalcounts)
 
 def hexcountsresults_to_df_DEPRECATED(db, save=False):
 
@@ -0,0 +1,330 @@
+"""
+Benchmarks of the main pipelines on synthetic Buenos Aires tweets.
+
+Tweets are generated around home and work locations of each user (drawn near a set of neighborhood centers inside
+CABA bounds), so findhome and the counts by residents behave as with real data. The database can be a local mongod
+(a separate database that is dropped before each run) or mongomock, an in-process stand-in (pip install mongomock).
+mongomock has no indexes and copies documents on each update, so it is meant for small scales only.
+
+Example:
+    python benchmark.py --scale 10k --backend mongomock
+    python benchmark.py --scale 1M --backend local --output benchmark_1M.csv
+    python benchmark.py --imports
+"""
+
+__author__ = 'Ricardo Pasquini'
+
+import os
+import sys
+import json
+import time
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+# CABA bounds and a few neighborhood centers (lat, lon)
+CABA_BOUNDS = {'latmin': -34.705, 'latmax': -34.527, 'lonmin': -58.531, 'lonmax': -58.335}
+CENTERS = np.array([[-34.6037, -58.3816],  # Microcentro
+                    [-34.5889, -58.4306],  # Palermo
+                    [-34.6177, -58.4370],  # Caballito
+                    [-34.5627, -58.4563],  # Belgrano
+                    [-34.6345, -58.3631],  # La Boca
+                    [-34.6395, -58.4621],  # Flores
+                    [-34.6166, -58.5050],  # Liniers
+                    [-34.5993, -58.3936]])  # Recoleta
+
+# number of users and tweets per user of each scale (about 10 thousand, 1 million and 20 million tweets)
+SCALES = {'10k': {'nusers': 200, 'tweetsperuser': 50},
+          '1M': {'nusers': 20000, 'tweetsperuser': 50},
+          '20M': {'nusers': 200000, 'tweetsperuser': 100}}
+
+# modules measured by import_times, and dependencies that should only load when a map or geometry is needed
+IMPORT_MODULES = ['instrumentation', 'dataaccess', 'my_h3_functions', 'home_index', 'home_location', 'analysis',
+                  'databasepopulation', 'communicationwmongo', 'snapshot']
+HEAVY_MODULES = ['geopandas', 'shapely', 'matplotlib', 'scipy']
+
+# ru_maxrss of the child process is inherited from the parent across fork and exec, so the peak is read from
+# VmHWM, which exec resets (and the resident memory before the import, to report the increase due to the import)
+_IMPORT_SCRIPT = """
+import sys, time, json
+
+def rss(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 2**10
+    except (IOError, OSError):
+        pass
+    return float('nan')
+
+rssbefore = rss('VmRSS')
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'peakrssMB': rss('VmHWM'), 'rssincreaseMB': rss('VmHWM') - rssbefore,
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def synthetic_tweets(nusers=200, tweetsperuser=50, concentration=0.02, start='2013-01-01', end='2015-12-31',
+                     firstuid=1, seed=0):
+    """
+    Generates tweets of synthetic users in raw format
+
+    :param nusers: number of users
+    :param tweetsperuser: mean number of tweets per user (geometric distribution, so a few users tweet a lot)
+    :param concentration: standard deviation (degrees) of homes and workplaces around neighborhood centers.
+                          Lower values concentrate users in fewer hexagons
+    :param start: first date of tweets
+    :param end: last date of tweets
+    :param firstuid: user id of the first user
+    :return: dataframe with u_id, lat, lon, created_at (milliseconds since epoch) and text columns
+    """
+    rng = np.random.RandomState(seed)
+
+    def locations(n):
+        centers = CENTERS[rng.randint(len(CENTERS), size=n)]
+        lat = np.clip(centers[:, 0] + rng.normal(0, concentration, n), CABA_BOUNDS['latmin'], CABA_BOUNDS['latmax'])
+        lon = np.clip(centers[:, 1] + rng.normal(0, concentration, n), CABA_BOUNDS['lonmin'], CABA_BOUNDS['lonmax'])
+        return lat, lon
+
+    homelat, homelon = locations(nusers)
+    worklat, worklon = locations(nusers)
+    ntweets = rng.geometric(1 / tweetsperuser, size=nusers)
+    user = np.repeat(np.arange(nusers), ntweets)
+    n = len(user)
+
+    # times: uniform dates, hours depend on where the user is
+    startms = pd.Timestamp(start).value // 10**6
+    days = (pd.Timestamp(end) - pd.Timestamp(start)).days + 1
+    day = rng.randint(days, size=n)
+    dayofweek = (pd.Timestamp(start).dayofweek + day) % 7
+    weekend = dayofweek >= 5
+
+    # 0 home, 1 work, 2 elsewhere in the city. At work only on weekdays
+    place = rng.choice(3, size=n, p=[0.5, 0.3, 0.2])
+    place[(place == 1) & weekend] = 0
+    hour = np.where(place == 0, rng.choice([0, 1, 2, 7, 8, 19, 20, 21, 22, 23], size=n), rng.randint(9, 19, size=n))
+    seconds = day * 86400 + hour * 3600 + rng.randint(3600, size=n)
+
+    randomlat, randomlon = locations(n)
+    lat = np.where(place == 0, homelat[user], np.where(place == 1, worklat[user], randomlat))
+    lon = np.where(place == 0, homelon[user], np.where(place == 1, worklon[user], randomlon))
+    # gps noise of a few meters
+    lat = lat + rng.normal(0, 0.0003, n)
+    lon = lon + rng.normal(0, 0.0003, n)
+
+    return pd.DataFrame({'u_id': firstuid + user, 'lat': lat, 'lon': lon,
+                         'created_at': startms + seconds.astype(np.int64) * 1000, 'text': 'synthetic tweet'})
+
+
+def benchmark_db(backend='mongomock', database='twitter_benchmark'):
+    """
+    Empty database for benchmarks
+
+    :param backend: 'mongomock' (in process, pip install mongomock) or 'local' (mongod at localhost)
+    """
+    if backend == 'mongomock':
+        try:
+            import mongomock
+        except ImportError:
+            raise ImportError("mongomock backend requires mongomock: pip install mongomock")
+        return mongomock.MongoClient()[database]
+
+    import communicationwmongo as commu
+    db = commu.connecttoLocaldb(database=database)
+    db.client.drop_database(database)
+    return db
+
+
+def populate_synthetic(db, nusers=200, tweetsperuser=50, usersperchunk=10000, **kwargs):
+    """
+    Inserts synthetic tweets (in raw format, without hexagons) and their users, usersperchunk users at a time
+
+    :return: number of tweets
+    """
+    ntweets = 0
+    for i, firstuser in enumerate(range(0, nusers, usersperchunk)):
+        kwargs['seed'] = kwargs.get('seed', 0) + i
+        chunk = synthetic_tweets(nusers=min(usersperchunk, nusers - firstuser), tweetsperuser=tweetsperuser,
+                                 firstuid=firstuser + 1, **kwargs)
+        db.tweets.insert_many(chunk.to_dict('records'))
+        db.users.insert_many([{'u_id': int(uid)} for uid in chunk['u_id'].unique()])
+        ntweets += chunk.shape[0]
+    db.users.create_index('u_id')
+    db.tweets.create_index('u_id')
+    return ntweets
+
+
+def _rss_mb(field='VmRSS'):
+    "Resident memory (VmRSS) or peak resident memory (VmHWM) of the process in MB, from /proc (linux only)"
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 2**10
+    except (IOError, OSError):
+        pass
+    return np.nan
+
+
+def _reset_peak_rss():
+    """Resets the peak resident memory of the process (VmHWM) to the current resident memory (linux >= 4.0).
+    ru_maxrss can not be reset, so it is the peak of all the benchmarks run before, not of the current one"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def measure(name, func, nitems, unit='tweets', tracememory=False):
+    """
+    Runs func and measures elapsed time and memory: peak resident memory while running (and its increase over the
+    resident memory before running), and optionally the peak memory allocated while running (with tracemalloc, which
+    slows down the code a lot)
+
+    :param nitems: number of items processed by func, to compute throughput
+    :return: dict with benchmark name, items, seconds, throughput, peak resident memory, its increase and peak
+             allocated memory in MB (NaN if they can not be measured in this platform)
+    """
+    rssbefore = _rss_mb()
+    resetpeak = _reset_peak_rss()
+    if tracememory:
+        tracemalloc.start()
+    starttime = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - starttime
+    peak = np.nan
+    if tracememory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    peakrss = _rss_mb('VmHWM') if resetpeak else np.nan
+
+    result = {'benchmark': name, 'items': nitems, 'unit': unit, 'seconds': seconds,
+              'throughput': nitems / max(seconds, 1e-9), 'peakrssMB': peakrss, 'rssincreaseMB': peakrss - rssbefore,
+              'peakallocatedMB': peak}
+    print('{benchmark}: {items} {unit} in {seconds:.2f} s, {throughput:.1f} {unit}/s, peak memory {peakrssMB:.1f} MB '
+          '(+{rssincreaseMB:.1f} MB)'.format(**result))
+    return result
+
+
+def import_times(modules=IMPORT_MODULES, repeat=3, output=None):
+    """
+    Import time of each module in a new python process, as paid by each new worker. Best of repeat runs
+
+    :param modules: list of module names
+    :param output: optional csv file with the results
+    :return: dataframe with module, seconds, peak resident memory of the process and its increase due to the import
+             in MB (NaN where /proc is not available) and heavy dependencies loaded by the import
+    """
+    results = []
+    for module in modules:
+        script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+        runs = []
+        for _ in range(repeat):
+            process = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                     stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            runs.append(json.loads(process.stdout.splitlines()[-1]))
+        best = min(runs, key=lambda run: run['seconds'])
+        result = {'module': module, 'seconds': best['seconds'], 'peakrssMB': best['peakrssMB'],
+                  'rssincreaseMB': best['rssincreaseMB'], 'heavymodules': ' '.join(best['heavy'])}
+        print('import {module}: {seconds:.3f} s, peak memory {peakrssMB:.1f} MB (+{rssincreaseMB:.1f} MB), '
+              'heavy modules: [{heavymodules}]'.format(**result))
+        results.append(result)
+
+    results = pd.DataFrame(results)
+    if output is not None:
+        results.to_csv(output, index=False)
+    return results
+
+
+def run_benchmarks(scale='10k', backend='mongomock', nsample=100, tracememory=False, output=None, **kwargs):
+    """
+    Benchmarks addhexjob, findhome (both methods), countsby_residents_and_non_residents, kring_smoothing and
+    hexcountsresults_to_df on synthetic data
+
+    :param scale: '10k', '1M' or '20M' (see SCALES)
+    :param backend: 'mongomock' or 'local'
+    :param nsample: number of users (findhome) and hexagons (countsby_residents_and_non_residents) measured
+    :param tracememory: also measure peak allocated memory of each benchmark with tracemalloc
+    :param output: optional csv file with the results
+    :param kwargs: synthetic_tweets parameters (concentration, start, end)
+    :return: dataframe with a row per benchmark
+    """
+    import warnings
+    warnings.simplefilter(action='ignore', category=FutureWarning)
+    import databasepopulation as dbp
+    import home_location as home
+    import analysis
+    import my_h3_functions as myh3
+
+    db = benchmark_db(backend=backend)
+    rng = np.random.RandomState(0)
+    results = []
+
+    starttime = time.perf_counter()
+    ntweets = populate_synthetic(db, **SCALES[scale], **kwargs)
+    print('synthetic tweets:', ntweets, 'time:', time.perf_counter() - starttime)
+
+    results.append(measure('addhexjob', lambda: dbp.addhexjob(db, chunksize=min(10000, ntweets)), ntweets,
+                           tracememory=tracememory))
+
+    uids = db.users.distinct('u_id')
+    sampleuids = rng.choice(uids, size=min(nsample, len(uids)), replace=False).tolist()
+    for method in ['latlon', 'hex9']:
+        results.append(measure('findhome ' + method,
+                               lambda: [home.findhomeandpopulate(uid, db, method=method, populate=False)
+                                        for uid in sampleuids], len(sampleuids), unit='users', tracememory=tracememory))
+
+    # homes of all users, needed by the counts
+    home.job_findhomeandpopulate_batch(db, method='hex9', nusers=5000)
+
+    hexs = db.tweets.distinct('hex.9')
+    samplehexs = rng.choice(hexs, size=min(nsample, len(hexs)), replace=False).tolist()
+    results.append(measure('countsby_residents_and_non_residents',
+                           lambda: [analysis.countsby_residents_and_non_residents(db, hexid) for hexid in samplehexs],
+                           len(samplehexs), unit='hexagons', tracememory=tracememory))
+
+    analysis.countandpopulatejob_all(db)
+    nhexs = db.hexcounts.count_documents({})
+    results.append(measure('hexcountsresults_to_df', lambda: analysis.hexcountsresults_to_df(db), nhexs,
+                           unit='hexagons', tracememory=tracememory))
+
+    hexdf = pd.DataFrame({'hexid': hexs, 'metric': rng.poisson(10, size=len(hexs))})
+    results.append(measure('kring_smoothing', lambda: myh3.kring_smoothing(hexdf, 'hexid', 'metric', 2), len(hexs),
+                           unit='hexagons', tracememory=tracememory))
+
+    results = pd.DataFrame(results)
+    results['scale'] = scale
+    results['backend'] = backend
+    if output is not None:
+        results.to_csv(output, index=False)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks on synthetic Buenos Aires tweets')
+    parser.add_argument('--scale', default='10k', choices=list(SCALES))
+    parser.add_argument('--backend', default='mongomock', choices=['mongomock', 'local'])
+    parser.add_argument('--nsample', type=int, default=100)
+    parser.add_argument('--concentration', type=float, default=0.02)
+    parser.add_argument('--start', default='2013-01-01')
+    parser.add_argument('--end', default='2015-12-31')
+    parser.add_argument('--tracememory', action='store_true', help='peak allocated memory of each benchmark (slow)')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--imports', action='store_true', help='only measure import time of the modules')
+    args = parser.parse_args()
+
+    if args.imports:
+        print(import_times(output=args.output))
+        sys.exit(0)
+
+    print(run_benchmarks(scale=args.scale, backend=args.backend, nsample=args.nsample,
+                         tracememory=args.tracememory, output=args.output, concentration=args.concentration,
+                         start=args.start, end=args.end))
@@ -1,12 +1,128 @@
 __author__ = 'Ricardo Pasquini'
 
-from pymongo import MongoClient
+import os
+import threading
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 import numpy as np
-import home_location as home
+import pandas as pd
+import my_h3_functions as myh3
+import dataaccess
 
-def connecttoLocaldb(database='twitter'):
-    client = MongoClient('localhost', 27017)
-    db = client[database]
+# Shared clients of this process, by connection settings (see get_client). Cleared in forked worker processes
+_clients = {}
+_clientsettings = {}  # get_client settings of each shared client, by id of the client
+_clientspid = None
+_clientslock = threading.Lock()
+
+
+def available_compressors():
+    """Wire compressors supported by the installed packages, best first: zstd (pip install zstandard, pymongo>=3.9),
+    snappy (pip install python-snappy) and zlib (always available)"""
+    compressors = []
+    try:
+        import zstandard
+        compressors.append('zstd')
+    except ImportError:
+        pass
+    try:
+        import snappy
+        compressors.append('snappy')
+    except ImportError:
+        pass
+    compressors.append('zlib')
+    return compressors
+
+
+def _is_local(host):
+    "True if host (a host name or mongodb:// uri) only names servers in this machine"
+    if host.startswith('mongodb'):
+        from pymongo.uri_parser import parse_uri
+        hosts = [node[0] for node in parse_uri(host)['nodelist']]
+    else:
+        hosts = [host]
+    return all(name in ('localhost', '127.0.0.1', '::1') or name.endswith('.sock') for name in hosts)
+
+
+def get_client(host='localhost', port=27017, maxPoolSize=100, compressors=None, readPreference='primary',
+               serverSelectionTimeoutMS=30000, socketTimeoutMS=None, **kwargs):
+    """
+    Pooled MongoClient shared by all the jobs and threads of the process.
+    A client is created for each distinct set of settings, and later calls with the same settings reuse it.
+    MongoClient is thread safe but not fork safe, so after a fork (multiprocessing workers) the clients of the parent
+    process are not reused and the worker creates its own.
+
+    :param host: host name or mongodb:// uri
+    :param maxPoolSize: maximum number of connections of the pool. Concurrent jobs need at least one per thread
+    :param compressors: wire compression, for instance 'zstd', 'snappy,zlib' or '' for none. Default is no compression
+                        for a local server (compressing only costs cpu there) and all the compressors available
+                        otherwise (see available_compressors), the server picks the first one it supports
+    :param readPreference: 'primary', 'secondaryPreferred'...
+    :param serverSelectionTimeoutMS: milliseconds to wait for an available server
+    :param socketTimeoutMS: milliseconds to wait for a response. Default is no timeout (long aggregations)
+    :param kwargs: other MongoClient options
+    :return: MongoClient
+    """
+    global _clientspid
+    if compressors is None:
+        compressors = '' if _is_local(host) else ','.join(available_compressors())
+    options = dict(kwargs, maxPoolSize=maxPoolSize, readPreference=readPreference,
+                   serverSelectionTimeoutMS=serverSelectionTimeoutMS)
+    if compressors:
+        options['compressors'] = compressors
+    if socketTimeoutMS is not None:
+        options['socketTimeoutMS'] = socketTimeoutMS
+    key = (host, port, tuple(sorted((name, repr(value)) for name, value in options.items())))
+
+    with _clientslock:
+        if _clientspid != os.getpid():  # new process: clients inherited from the parent can not be used
+            _clients.clear()
+            _clientsettings.clear()
+            _clientspid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = MongoClient(host, port, **options)
+            _clientsettings[id(client)] = dict(options, host=host, port=port, compressors=compressors)
+    return client
+
+
+def client_settings(client):
+    """
+    get_client settings (host, port, credentials and all other options) of a shared client, to open the same
+    connection in another process
+
+    :return: dict of get_client parameters, None if the client was not created by get_client in this process
+    """
+    with _clientslock:
+        if _clientspid != os.getpid() or not any(shared is client for shared in _clients.values()):
+            return None
+        return dict(_clientsettings[id(client)])
+
+
+def close_clients():
+    """Closes the shared clients of this process"""
+    with _clientslock:
+        if _clientspid == os.getpid():
+            for client in _clients.values():
+                client.close()
+        _clients.clear()
+        _clientsettings.clear()
+
+
+def pool_size(db):
+    """Maximum number of connections of the client of db, None if it is not a pymongo client (for instance mongomock)"""
+    if not isinstance(db.client, MongoClient):
+        return None
+    return db.client.options.pool_options.max_pool_size
+
+
+def connecttoLocaldb(database='twitter', **kwargs):
+    """
+    Database of the shared pooled client (see get_client)
+
+    :param kwargs: get_client settings (host, port, maxPoolSize, compressors...)
+    """
+    db = get_client(**kwargs)[database]
     return db
 
 
@@ -20,7 +136,7 @@ def users_in_tweets_not_in_userscollection(db):
     Reports last user id processed and number of pending uids"""
     newcursor=obtain_list_of_user_ids(db)
     print('total number of u_ids :', len(newcursor))
-    idoflast=db.users.find().sort('u_id',-1).limit(1)[0]
+    idoflast=db.users.find({}, {'_id': 0, 'u_id': 1}).sort('u_id',-1).limit(1)[0]
     print('last u_id processed:', idoflast['u_id'])
     newlist = list(filter(lambda x: x > idoflast['u_id'], newcursor))
     print('number of pending u_ids :', len(newlist))
@@ -30,12 +146,68 @@ def users_in_tweets_not_in_userscollection(db):
 def counttweetsandupdate(db):
     from bson.objectid import ObjectId
 
-    cursor=db.radios.find()
+    cursor=db.radios.find({}, {'geometry': 1})
     #db.tweets2.find( { 'location': { '$geoWithin': { '$geometry': cursor['geometry'] } } } ).count()
     for radio in cursor:
         totalradiocount=db.tweets2.find( { 'location': { '$geoWithin': { '$geometry': radio['geometry'] } } } ).count()
         recordid=radio['_id']
         db.radios.update({'_id': recordid},  {'$set': {"tweets.totalcount": totalradiocount}})
 
+def radios_gdf_from_db(db, collectionname='radios', codecol='COD_2010_1'):
+    "Reads radios codes and geometries (GeoJSON, holes included) into a geodataframe"
+    import geopandas as gpd
+    from shapely.geometry import shape
+
+    cursor = db[collectionname].find({}, {codecol: 1, 'geometry': 1})
+    docs = list(cursor)
+    gdf = gpd.GeoDataFrame({'_id': [doc['_id'] for doc in docs], codecol: [doc[codecol] for doc in docs]},
+                           geometry=[shape(doc['geometry']) for doc in docs])
+    gdf.crs = {'init': 'epsg:4326', 'no_defs': True}
+    return gdf
+
+
+def tweets_to_radios(db, radiosgdf, radiohexs, collectionname='tweets2', resolution='10', codecol='COD_2010_1'):
+    """
+    Assigns all tweets to census radios in a single scan, using the radio to hexagon index
+
+    :param radiosgdf: radios geodataframe (see radios_gdf_from_db)
+    :param radiohexs: radio to hexagon index at the given resolution (see my_h3_functions.polygons_hex_index)
+    :return: dataframe of tweets with u_id, created_at and radio code (None if outside all radios)
+    """
+    fields = {'u_id': 'u_id', 'created_at': 'created_at', 'hex': 'hex.' + resolution}
+    fields.update(dataaccess.coordinate_fields('location'))
+    tweets = dataaccess.read_columns(db[collectionname], {}, fields)
+    polygons = dict(zip(radiosgdf[codecol], radiosgdf.geometry))
+
+    tweets['code'] = myh3.points_to_polygons_with_hexindex(tweets['lon'].to_numpy(), tweets['lat'].to_numpy(),
+                                                           radiohexs, polygons, hexids=tweets['hex'].to_numpy())
+    return tweets[['u_id', 'created_at', 'code']]
+
+
+def counttweetsandupdate_hexindex(db, radiohexs=None, collectionname='tweets2', resolution='10', sizeofchunk=1000):
+    """
+    Same as counttweetsandupdate, with a single scan of tweets instead of a $geoWithin query for each radio.
+    Tweets are assigned to radios by their hex id, only tweets in hexagons crossing radios boundaries are checked
+    with point in polygon tests.
+
+    :param radiohexs: radio to hexagon index. Built with my_h3_functions.polygons_hex_index if not given
+    :param resolution: resolution of the hex ids stored in tweets (hex.<resolution>)
+    """
+    radiosgdf = radios_gdf_from_db(db)
+    if radiohexs is None:
+        radiohexs = myh3.polygons_hex_index(radiosgdf, codecol='COD_2010_1', hexresolution=int(resolution))
+
+    tweets = tweets_to_radios(db, radiosgdf, radiohexs, collectionname=collectionname, resolution=resolution)
+    counts = tweets['code'].value_counts()
+
+    requests = [UpdateOne({'_id': recordid}, {'$set': {"tweets.totalcount": int(counts.get(code, 0))}})
+                for recordid, code in zip(radiosgdf['_id'], radiosgdf['COD_2010_1'])]
+    for i in range(0, len(requests), sizeofchunk):
+        try:
+            db.radios.bulk_write(requests[i:i+sizeofchunk], ordered=False)
+        except BulkWriteError as bwe:
+            print(bwe.details)
+
+
 if __name__ == "__main__":
     db=connecttoLocaldb(database='twitter')
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""
+Projected and typed reads of tweets and users collections.
+
+Each use case reads only the fields it needs, and results are returned as typed columns: int64 u_id, float64 lat and
+lon, datetime64 created_at and hex ids as strings (or uint64, see my_h3_functions.hexs_to_int).
+Hex ids can be stored in tweets as strings or as 64 bits integers (see databasepopulation.migrate_compact_storage),
+queries match both forms (see hex_query).
+If pymongoarrow is installed, documents are decoded from raw BSON directly into arrays (no python dicts).
+pymongoarrow infers a single type for each field, so reads of hex ids and dates stored with mixed types (during a
+migration) fall back to the python decoder.
+"""
+
+__author__ = 'Ricardo Pasquini'
+
+import numpy as np
+import pandas as pd
+import pymongo
+from bson import ObjectId
+import my_h3_functions as myh3
+
+try:
+    from pymongoarrow.api import aggregate_arrow_all
+except ImportError:
+    aggregate_arrow_all = None
+
+BATCH_SIZE = 10000
+
+# columns (by name prefix) that can be stored with different types in the same collection: hex ids as strings or
+# integers, created_at as milliseconds or dates
+MIXED_TYPE_COLUMNS = ('hex', 'created_at')
+
+
+def _path_expression(path):
+    """Aggregation expression of a field path. A numeric last part indexes an array (location.coordinates.0) or is
+    the name of a field of an embedded document (hex.9), as in _path_value"""
+    parts = path.split('.')
+    if parts[-1].isdigit():
+        parent = '$' + '.'.join(parts[:-1])
+        return {'$cond': [{'$isArray': parent}, {'$arrayElemAt': [parent, int(parts[-1])]}, '$' + path]}
+    return '$' + path
+
+
+def _path_value(doc, parts):
+    "Value of a field path in a document, None if missing"
+    for part in parts:
+        if isinstance(doc, list):
+            doc = doc[int(part)] if int(part) < len(doc) else None
+        elif isinstance(doc, dict):
+            doc = doc.get(part)
+        else:
+            return None
+    return doc
+
+
+def _read_arrow(collection, query, fields, sort, limit, batch_size):
+    """Reads columns with pymongoarrow, projecting field paths in the server.
+    The BSON type of columns that can have mixed types is also projected. Returns None if any of them has more than
+    one type, since pymongoarrow would read the values of all but one type as nulls"""
+    pipeline = [{'$match': query}]
+    if sort is not None:
+        pipeline.append({'$sort': dict(sort)})
+    if limit:
+        pipeline.append({'$limit': limit})
+    project = {'_id': 0}
+    project.update({column: _path_expression(path) for column, path in fields.items()})
+    typecolumns = {column: '_type_' + column for column in fields if column.startswith(MIXED_TYPE_COLUMNS)}
+    project.update({typecolumn: {'$type': _path_expression(fields[column])}
+                    for column, typecolumn in typecolumns.items()})
+    pipeline.append({'$project': project})
+
+    table = aggregate_arrow_all(collection, pipeline, batchSize=batch_size)
+    for typecolumn in typecolumns.values():
+        if typecolumn in table.column_names:
+            types = set(table.column(typecolumn).to_pylist()) - {'missing', 'null'}
+            if len(types) > 1:
+                return None
+    return {column: (table.column(column).to_numpy(zero_copy_only=False) if column in table.column_names
+                     else np.full(table.num_rows, None, dtype=object)) for column in fields}
+
+
+def _read_python(collection, query, fields, sort, limit, batch_size):
+    "Reads columns with a projected cursor"
+    projection = {'_id': 0} if '_id' not in fields.values() else {}
+    for path in fields.values():
+        projection['.'.join(part for part in path.split('.') if not part.isdigit())] = 1
+
+    cursor = collection.find(query, projection, batch_size=batch_size)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    paths = {column: path.split('.') for column, path in fields.items()}
+    values = {column: [] for column in fields}
+    for doc in cursor:
+        for column, parts in paths.items():
+            values[column].append(_path_value(doc, parts))
+    return values
+
+
+def dates_array(values, truncate=False):
+    """
+    Dates stored as milliseconds since epoch (raw data), as dates, or both mixed (documents of a collection being
+    migrated to compact storage, see databasepopulation.migrate_compact_storage). Each value is converted by its type
+
+    :param truncate: milliseconds since epoch are truncated to seconds
+    :return: datetime64[ns] array (NaT for missing values)
+    """
+    def from_ms(ms):
+        ms = np.asarray(ms).astype(np.int64)
+        return pd.to_datetime(ms // 1000, unit='s').values if truncate else pd.to_datetime(ms, unit='ms').values
+
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]')
+    if values.dtype.kind in 'iuf':
+        return from_ms(values)
+
+    isnumber = np.array([isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool)
+                         for value in values], dtype=bool)
+    dates = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[ns]')
+    if isnumber.any():
+        dates[isnumber] = from_ms(values[isnumber])
+    if not isnumber.all():
+        dates[~isnumber] = pd.to_datetime(list(values[~isnumber])).values
+    return dates
+
+
+def _typed(column, values, hexasint=False):
+    "Converts a column to its type, by column name"
+    if column == '_id':  # pymongoarrow decodes ObjectIds as 12 bytes
+        return np.array([ObjectId(value) if isinstance(value, bytes) else value for value in values], dtype=object)
+    if column == 'u_id':
+        return np.asarray(values, dtype=np.int64)
+    if column in ('lat', 'lon'):
+        return np.asarray(values, dtype=np.float64)
+    if column == 'created_at':
+        return dates_array(values)
+    if column.startswith('hex'):  # stored as strings or as integers
+        if hexasint:
+            return np.array([myh3.hex_to_int(hexid) if hexid else 0 for hexid in values], dtype=np.uint64)
+        return myh3.hexs_to_str(values)
+    return np.asarray(values, dtype=object)
+
+
+def read_columns(collection, query=None, fields=None, sort=None, limit=0, batch_size=BATCH_SIZE, hexasint=False,
+                 usearrow=None):
+    """
+    Reads the results of a query as a dataframe of typed columns
+
+    :param collection: pymongo collection
+    :param fields: dict of column name and field path (nested fields with dots, array elements with numbers,
+                   for instance {'lon': 'location.coordinates.0'})
+    :param sort: optional list of (field, direction)
+    :param batch_size: number of documents of each round trip
+    :param hexasint: hex ids (columns starting with hex) as uint64 instead of strings
+    :param usearrow: decode with pymongoarrow. Default is to use it when installed. Reads with mixed types of hex ids
+                     or dates are decoded in python anyway
+    :return: dataframe with a column for each field
+    """
+    query = query or {}
+    if usearrow is None:
+        usearrow = aggregate_arrow_all is not None and isinstance(collection, pymongo.collection.Collection)
+
+    values = None
+    if usearrow:
+        values = _read_arrow(collection, query, fields, sort, limit, batch_size)
+    if values is None:
+        values = _read_python(collection, query, fields, sort, limit, batch_size)
+    return pd.DataFrame({column: _typed(column, values[column], hexasint=hexasint) for column in fields},
+                        columns=list(fields))
+
+
+def hex_query(hexids):
+    """
+    Condition matching hex ids in both storage forms, strings and 64 bits integers
+
+    :param hexids: a hex id or a list of hex ids, as strings or integers
+    :return: {'$in': [...]} condition
+    """
+    if isinstance(hexids, (str, int, np.integer)):
+        hexids = [hexids]
+    forms = []
+    for hexid in hexids:
+        forms.extend([myh3.hex_to_str(hexid), myh3.hex_to_int(hexid)])
+    return {'$in': forms}
+
+
+##########Projections of each use case
+
+def coordinate_fields(dataformat='raw'):
+    "Paths of coordinates: lat and lon fields in raw data, otherwise mongo location field (lon, lat order)"
+    if dataformat == 'raw':
+        return {'lat': 'lat', 'lon': 'lon'}
+    return {'lat': 'location.coordinates.1', 'lon': 'location.coordinates.0'}
+
+
+def user_tweets(db, uids, dataformat='raw', collectionname='tweets', **kwargs):
+    """
+    Tweets of a list of users, with the fields used to find homes
+
+    :return: dataframe with u_id, lat, lon, hex9 and created_at columns
+    """
+    fields = {'u_id': 'u_id'}
+    fields.update(coordinate_fields(dataformat))
+    fields.update({'hex9': 'hex.9', 'created_at': 'created_at'})
+    return read_columns(db[collectionname], {'u_id': {'$in': [int(uid) for uid in uids]}}, fields, **kwargs)
+
+
+def hex_tweets(db, hexid, resolution='9', collectionname='tweets', **kwargs):
+    """
+    Tweets in a hexagon, with the fields used to count them
+
+    :return: dataframe with u_id, created_at and hex<resolution> columns
+    """
+    return read_columns(db[collectionname], {'hex.' + resolution: hex_query(hexid)},
+                        {'u_id': 'u_id', 'created_at': 'created_at', 'hex' + resolution: 'hex.' + resolution}, **kwargs)
+
+
+def tweets_with_hex(db, query=None, resolution='9', collectionname='tweets', **kwargs):
+    """
+    Hexagon, user and date of tweets
+
+    :return: dataframe with u_id, hex and created_at columns
+    """
+    return read_columns(db[collectionname], query,
+                        {'u_id': 'u_id', 'hex': 'hex.' + resolution, 'created_at': 'created_at'}, **kwargs)
+
+
+def user_ids(db, query=None, collectionname='users', **kwargs):
+    """User ids of the users matching query, as an int64 array"""
+    return read_columns(db[collectionname], query, {'u_id': 'u_id'}, **kwargs)['u_id'].to_numpy()
+
+
+def user_homes(db, resolution='9', query=None, **kwargs):
+    """
+    Home hexagons of users with home found at the given resolution
+
+    :return: dataframe with u_id and hex<resolution> columns
+    """
+    homefield = 'hex' + resolution + '.' + 'hex' + resolution
+    query = dict(query or {}, **{homefield: {'$exists': True}})
+    return read_columns(db['users'], query, {'u_id': 'u_id', 'hex' + resolution: homefield}, **kwargs)
@@ -8,6 +8,12 @@ import time
 from pymongo.errors import BulkWriteError
 from bson.objectid import ObjectId
 import pymongo
+import numpy as np
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from instrumentation import JobMetrics
+import my_h3_functions as myh3
 
 def populatetweets(db, path='D:\\twitter\\', cityprefix='ba', yearstart=2012, yearend=2015, chunksize=1000):
 
@@ -30,6 +36,70 @@ def populatetweets(db, path='D:\\twitter\\', cityprefix='ba', yearstart=2012, ye
 
 
 
+def prepare_tweets_for_insert(df, resolutions=(9, 10), hexformat='str'):
+    """
+    Adds to a chunk of raw tweets the fields otherwise added after population:
+    hex ids (hex.<resolution>), a GeoJSON location point and created_at as a native datetime
+
+    :param df: dataframe of raw tweets (a chunk of the csv file)
+    :param hexformat: 'str' stores hex ids as strings, 'int' as 64 bits integers (see migrate_compact_storage)
+    :return: list of documents ready for insert_many
+    """
+    hexs = geo_to_h3_arrays(df['lat'], df['lon'], resolutions=resolutions, hexformat=hexformat)
+    records = df.assign(created_at=pd.to_datetime(df['created_at'], unit='ms')).to_dict('records')
+
+    for i, record in enumerate(records):
+        record['hex'] = {str(resolution): hexs[resolution][i] for resolution in resolutions}
+        record['location'] = {'type': 'Point', 'coordinates': [record['lon'], record['lat']]}
+    return records
+
+
+def _insert_many(collection, documents):
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as bwe:
+        print(bwe.details)
+    return len(documents)
+
+
+def populatetweets_with_hexs(db, path='D:\\twitter\\', cityprefix='ba', yearstart=2012, yearend=2015, chunksize=10000,
+                             batchsize=1000, resolutions=(9, 10), nwriters=4, hexformat='str'):
+
+    """ Populates tweets in csv file to mongodb twitter.tweets collection, computing hex ids, location and datetimes
+    at ingest time (see prepare_tweets_for_insert). Replaces populatetweets followed by addhexjob.
+    Inserts are unordered and run in parallel, in batches of batchsize documents.
+
+    :param path: Path to csv location
+    :param cityprefix: city prefix in the csv file name
+    :param chunksize: number of csv rows read at a time
+    :param batchsize: number of documents in each insert_many
+    :param resolutions: list of h3 resolutions
+    :param nwriters: number of concurrent inserts
+    :param hexformat: 'str' stores hex ids as strings, 'int' as 64 bits integers (see migrate_compact_storage)
+
+    """
+    start_time = time.time()
+    inserted = 0
+    pendinginserts = set()
+
+    with ThreadPoolExecutor(max_workers=nwriters) as writers:
+        for year in range(yearstart, yearend+1):
+            print('Now populating year ',year)
+            for df in pd.read_csv(path+cityprefix+'_'+str(year)+'.csv', chunksize=chunksize):
+                records = prepare_tweets_for_insert(df, resolutions=resolutions, hexformat=hexformat)
+                for i in range(0, len(records), batchsize):
+                    # backpressure: no more than nwriters inserts waiting
+                    if len(pendinginserts) >= nwriters:
+                        done, pendinginserts = wait(pendinginserts, return_when=FIRST_COMPLETED)
+                        _check_writes(done)
+                    pendinginserts.add(writers.submit(_insert_many, db.tweets, records[i:i+batchsize]))
+                inserted += len(records)
+                print(' tweets:', inserted, ' tweets/sec:', inserted / (time.time() - start_time))
+        _check_writes(wait(pendinginserts).done)
+
+    print('process completed')
+
+
 def add_hexs_and_prepare_bulk_request(df, dataformat='raw'):
     """
     Apply geo_to_h3 to a chunk of tweets and prepare bulk request
@@ -73,47 +143,249 @@ def add_hexs_and_prepare_bulk_request(df, dataformat='raw'):
 
 
 
-def addhexjob(db, chunksize = 1000, dataformat='raw'):
+def addhexjob(db, chunksize = 1000, dataformat='raw', metrics=None):
 
     """ Add hex ids to tweets collection. Smart job in chunks
     :param dataformat: raw refers to raw twitter data, otherwise, if tweets have been already reshaped to mongo geolocation choose 'mongo'
+    :param metrics: optional instrumentation.JobMetrics. Times read, compute and write stages of each chunk
 
     """
     collectionname='tweets'
 
-
-    start_time = time.time()
-
     collectionsize = db[collectionname].count()
 
+    if metrics is None:
+        metrics = JobMetrics('addhexjob', total=int(collectionsize), unit='tweets')
+
     iteration = 1
 
-    while iteration < (int(collectionsize / chunksize) + 1):
-        iter_start_time = time.time()
-        if iteration > 1:
-            cursor = db[collectionname].find({'_id': {'$gt': last_object_id}}).sort('_id', 1).limit(chunksize)
-            # alternatively I could have done '$lt' and sort -1 as suggest in the documentation
-        else:
-            cursor = db[collectionname].find().sort('_id', 1).limit(chunksize)
+    while iteration < (int(np.ceil(collectionsize / chunksize)) + 1):  # last chunk can be smaller
+        with metrics.stage('read'):
+            if iteration > 1:
+                cursor = db[collectionname].find({'_id': {'$gt': last_object_id}}).sort('_id', 1).limit(chunksize)
+                # alternatively I could have done '$lt' and sort -1 as suggest in the documentation
+            else:
+                cursor = db[collectionname].find().sort('_id', 1).limit(chunksize)
 
-        df = pd.DataFrame(list(cursor))
+            df = pd.DataFrame(list(cursor))
 
-        requests = add_hexs_and_prepare_bulk_request(df, dataformat=dataformat)
+        with metrics.stage('compute'):
+            requests = add_hexs_and_prepare_bulk_request(df, dataformat=dataformat)
 
-        try:
-            db[collectionname].bulk_write(requests, ordered=False)
-        except BulkWriteError as bwe:
-            print(bwe.details)
+        with metrics.stage('write'):
+            try:
+                db[collectionname].bulk_write(requests, ordered=False)
+            except BulkWriteError as bwe:
+                print(bwe.details)
+                metrics.count('bulkwriteerrors')
 
         # obtengo el last id del dataframe
         last_object_id = df.iloc[-1]['_id']
 
-        iter_end_time = time.time()
-        print(' iter:', iteration, ' time:', iter_end_time - iter_start_time)
+        metrics.progress(df.shape[0])
         iteration += 1
 
+    metrics.close()
+
+
+def geo_to_h3_arrays(lat, lon, resolutions=(9, 10), hexformat='str'):
+    """
+    Hex ids for arrays of coordinates, at several resolutions.
+    Repeated coordinates (very common in tweets) are converted only once.
+
+    :param lat: array of latitudes
+    :param lon: array of longitudes
+    :param resolutions: list of h3 resolutions
+    :param hexformat: 'str' for hex ids as strings, 'int' as python ints (stored in mongo as 64 bits integers)
+    :return: dict with an array of hex ids for each resolution
+    """
+    coordinates = np.column_stack([np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)])
+    if coordinates.shape[0] == 0:
+        return {resolution: np.array([], dtype=object) for resolution in resolutions}
+
+    uniquecoordinates, inverse = np.unique(coordinates, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+
+    hexs = {}
+    for resolution in resolutions:
+        uniquehexs = np.array([h3.geo_to_h3(la, lo, resolution) for la, lo in uniquecoordinates], dtype=object)
+        if hexformat == 'int':
+            uniquehexs = np.array([myh3.hex_to_int(hexid) for hexid in uniquehexs], dtype=object)
+        hexs[resolution] = uniquehexs[inverse]
+    return hexs
+
+
+def _read_chunks(cursor, chunksize, chunks):
+    "Reads cursor in chunks of documents into chunks queue. Ends with None"
+    try:
+        chunk = []
+        for doc in cursor:
+            chunk.append(doc)
+            if len(chunk) == chunksize:
+                chunks.put(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            chunks.put(chunk)
+    except Exception as e:
+        chunks.put(e)
+    chunks.put(None)
+
+
+def _bulk_write(collection, requests):
+    try:
+        collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as bwe:
+        print(bwe.details)
+    return len(requests)
+
+
+def _check_writes(done):
+    """Raises the error of any finished write. Duplicates and other write errors (BulkWriteError) are printed by the
+    writer, but connection and server errors (AutoReconnect, NetworkTimeout, OperationFailure...) stop the job"""
+    for write in done:
+        write.result()
+
+
+def addhexjob_streaming(db, chunksize=10000, resolutions=(9, 10), dataformat='raw', onlypending=False, nwriters=2,
+                        hexformat='str'):
+
+    """ Add hex ids to tweets collection in a single pass.
+    Only _id and coordinates are read, with a projected cursor in a separate thread. Hex ids are computed for whole
+    chunks of coordinates, and bulk writes run in background threads while the next chunk is read and hexed.
+
+    :param chunksize: number of tweets in each chunk
+    :param resolutions: list of h3 resolutions, stored as hex.<resolution>
+    :param dataformat: raw refers to raw twitter data (lat and lon fields), otherwise coordinates are read from mongo location field (lon, lat order)
+    :param onlypending: if True only tweets without hex field are processed
+    :param nwriters: number of concurrent bulk writes
+    :param hexformat: 'str' stores hex ids as strings, 'int' as 64 bits integers (see migrate_compact_storage)
+
+    """
+    collectionname='tweets'
+    collection=db[collectionname]
+
+    if dataformat=='raw':
+        projection={'_id': 1, 'lat': 1, 'lon': 1}
+    else:
+        projection={'_id': 1, 'location.coordinates': 1}
+    query={'hex': {'$exists': False}} if onlypending else {}
+
+    cursor=collection.find(query, projection).sort('_id', 1).batch_size(chunksize)
+
+    # reading in a separate thread. The queue bounds the chunks read in advance
+    chunks=queue.Queue(maxsize=2)
+    reader=threading.Thread(target=_read_chunks, args=(cursor, chunksize, chunks), daemon=True)
+
+    start_time = time.time()
+    reader.start()
+    iteration=1
+    processed=0
+    pendingwrites=set()
+
+    with ThreadPoolExecutor(max_workers=nwriters) as writers:
+        while True:
+            iter_start_time = time.time()
+            chunk=chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            ids=[doc['_id'] for doc in chunk]
+            if dataformat=='raw':
+                lat=[doc['lat'] for doc in chunk]
+                lon=[doc['lon'] for doc in chunk]
+            else:
+                lon=[doc['location']['coordinates'][0] for doc in chunk]
+                lat=[doc['location']['coordinates'][1] for doc in chunk]
+
+            hexs=geo_to_h3_arrays(lat, lon, resolutions=resolutions, hexformat=hexformat)
+            requests=[UpdateOne({'_id': ids[i]}, {'$set': {'hex': {str(resolution): hexs[resolution][i] for resolution in resolutions}}})
+                      for i in range(len(ids))]
+
+            # backpressure: no more than nwriters bulk writes waiting
+            if len(pendingwrites) >= nwriters:
+                done, pendingwrites = wait(pendingwrites, return_when=FIRST_COMPLETED)
+                _check_writes(done)
+            pendingwrites.add(writers.submit(_bulk_write, collection, requests))
+
+            processed+=len(ids)
+            iter_end_time = time.time()
+            print(' iter:', iteration, ' time:', iter_end_time - iter_start_time,
+                  ' tweets/sec:', processed / (iter_end_time - start_time))
+            iteration+=1
+
+        _check_writes(wait(pendingwrites).done)
+
     end_time = time.time()
-    print('total elapsed time:', end_time - start_time)
+    print('total elapsed time:', end_time - start_time, ' tweets:', processed,
+          ' tweets/sec:', processed / max(end_time - start_time, 1e-9))
+
+
+def _compact_update(doc, resolutions):
+    "$set of the fields of a tweet document not yet in compact form, None if there are none"
+    update = {}
+    for resolution in resolutions:
+        hexid = doc.get('hex', {}).get(resolution)
+        if isinstance(hexid, str):
+            update['hex.' + resolution] = myh3.hex_to_int(hexid)
+    created_at = doc.get('created_at')
+    if isinstance(created_at, (int, float)) and not isinstance(created_at, bool):
+        update['created_at'] = pd.Timestamp(int(created_at), unit='ms').to_pydatetime()  # milliseconds since epoch
+    if isinstance(doc.get('u_id'), float):
+        update['u_id'] = int(doc['u_id'])
+    return update or None
+
+
+def migrate_compact_storage(db, chunksize=10000, resolutions=('9', '10'), collectionname='tweets', metrics=None):
+
+    """ Migrates tweets to compact storage: hex ids as 64 bits integers instead of 15 characters strings,
+    created_at as BSON date instead of milliseconds since epoch and u_id as integer instead of double.
+    Documents and hex indexes get smaller, and hex ids are compared as integers. Queries in dataaccess and analysis
+    accept both forms, so the collection can be used while it is migrated. Already migrated documents are skipped,
+    so the job can be stopped and run again.
+
+    :param chunksize: number of tweets in each bulk write
+    :param resolutions: hex resolutions to migrate (hex.<resolution> fields)
+    :param metrics: optional instrumentation.JobMetrics. Times read and write stages of each chunk
+
+    """
+    collection = db[collectionname]
+    query = {'$or': [{'hex.' + resolution: {'$type': 'string'}} for resolution in resolutions] +
+                    [{'created_at': {'$type': 'double'}}, {'created_at': {'$type': 'long'}},
+                     {'created_at': {'$type': 'int'}}, {'u_id': {'$type': 'double'}}]}
+    projection = {'_id': 1, 'u_id': 1, 'created_at': 1}
+    projection.update({'hex.' + resolution: 1 for resolution in resolutions})
+
+    if metrics is None:
+        metrics = JobMetrics('migrate_compact_storage', total=collection.count_documents(query), unit='tweets')
+
+    last_object_id = None
+    while True:
+        with metrics.stage('read'):
+            chunkquery = query if last_object_id is None else {'$and': [query, {'_id': {'$gt': last_object_id}}]}
+            docs = list(collection.find(chunkquery, projection).sort('_id', 1).limit(chunksize))
+        if len(docs) == 0:
+            break
+
+        requests = []
+        for doc in docs:
+            update = _compact_update(doc, resolutions)
+            if update is not None:
+                requests.append(UpdateOne({'_id': doc['_id']}, {'$set': update}))
+
+        with metrics.stage('write'):
+            if len(requests) > 0:
+                try:
+                    collection.bulk_write(requests, ordered=False)
+                except BulkWriteError as bwe:
+                    print(bwe.details)
+                    metrics.count('bulkwriteerrors')
+
+        last_object_id = docs[-1]['_id']
+        metrics.progress(len(docs))
+
+    metrics.close()
 
 
 def create_indexes(db):
@@ -144,6 +416,15 @@ def populate_hexcounts_collection(db):
     db.tweets.aggregate( [ { '$group' : { '_id' : "$hex.9" } } ,
                            { "$project": { "_id": 0, "_id": "$_id"}}, { '$out' : "hexcounts" }] )
 
+    # hex ids of migrated tweets (see migrate_compact_storage) are integers, hexcounts are identified by strings
+    hexints = [doc['_id'] for doc in db.hexcounts.find({'_id': {'$type': 'long'}}, {'_id': 1})]
+    if len(hexints) > 0:
+        db.hexcounts.delete_many({'_id': {'$in': hexints}})
+        hexids = set(myh3.hexs_to_str(hexints))
+        hexids -= {doc['_id'] for doc in db.hexcounts.find({'_id': {'$in': list(hexids)}}, {'_id': 1})}
+        if len(hexids) > 0:
+            db.hexcounts.insert_many([{'_id': hexid} for hexid in sorted(hexids)])
+
 
 if __name__ == "__main__":
     db=populatetweets('twitter')
\ No newline at end of file
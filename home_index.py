@@ -0,0 +1,106 @@
+__author__ = 'Ricardo Pasquini'
+
+import os
+import numpy as np
+from h3 import h3
+import my_h3_functions as myh3
+import dataaccess
+
+
+class HomeIndex:
+    """In memory index of users home hexagons, built once from users collection.
+
+    Maps each hexagon to the sorted array of user ids living in it, and each user id to its home hexagon.
+    Hexagons are stored as 64 bits integers (see my_h3_functions.hexs_to_int), and the index can be cached to disk
+    as .npy files that are reloaded memory-mapped.
+
+    Example:
+        index = HomeIndex.cached(db, './homeindex')
+        index.users_in_hex('89c2e311e17ffff')
+    """
+
+    arraynames = ['hexs', 'uids_by_hex', 'uids', 'homes']
+
+    def __init__(self, hexs, uids_by_hex, uids, homes, resolution='9'):
+        self.hexs = hexs  # home hexagons of all users, sorted
+        self.uids_by_hex = uids_by_hex  # user ids in the same order (sorted by hexagon and user id)
+        self.uids = uids  # user ids, sorted
+        self.homes = homes  # home hexagon of each user in uids
+        self.resolution = resolution
+
+    @classmethod
+    def from_arrays(cls, uids, homes, resolution='9'):
+        """Builds the index from arrays of user ids and home hexagons (as strings or integers)"""
+        uids = np.asarray(uids, dtype=np.int64)
+        homes = np.asarray(homes)
+        if homes.dtype != np.uint64:
+            homes = myh3.hexs_to_int(homes)
+
+        byhex = np.lexsort((uids, homes))
+        byuid = np.argsort(uids, kind='mergesort')
+        return cls(homes[byhex], uids[byhex], uids[byuid], homes[byuid], resolution=resolution)
+
+    @classmethod
+    def from_db(cls, db, resolution='9'):
+        """Builds the index from users collection (users with home found at the given hex resolution)"""
+        users = dataaccess.user_homes(db, resolution=resolution, hexasint=True)
+        return cls.from_arrays(users['u_id'].to_numpy(), users['hex' + resolution].to_numpy(), resolution=resolution)
+
+    def save(self, path):
+        """Saves the index arrays as .npy files in path directory"""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in self.arraynames:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'resolution.txt'), 'w') as f:
+            f.write(self.resolution)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads an index saved with save. Arrays are memory-mapped unless mmap is False"""
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None) for name in cls.arraynames]
+        with open(os.path.join(path, 'resolution.txt')) as f:
+            resolution = f.read().strip()
+        return cls(*arrays, resolution=resolution)
+
+    @classmethod
+    def cached(cls, db, path, resolution='9', rebuild=False):
+        """Loads the index from path if it was already saved there, otherwise builds it from db and saves it"""
+        if not rebuild and os.path.exists(os.path.join(path, 'homes.npy')):
+            return cls.load(path)
+        index = cls.from_db(db, resolution=resolution)
+        index.save(path)
+        return index
+
+    def to_parent(self, resolution):
+        """Index of the same users with their homes at a coarser resolution"""
+        return HomeIndex.from_arrays(self.uids, myh3.hexs_to_parents(np.asarray(self.homes), int(resolution)),
+                                     resolution=str(resolution))
+
+    def __len__(self):
+        return len(self.uids)
+
+    def users_in_hex(self, hexid):
+        """Sorted array of user ids living in hexid"""
+        hexint = np.uint64(int(hexid, 16))
+        start = np.searchsorted(self.hexs, hexint, side='left')
+        end = np.searchsorted(self.hexs, hexint, side='right')
+        return np.asarray(self.uids_by_hex[start:end])
+
+    def users_in_hex_plus_neighbors(self, hexid, contiguity=1):
+        """User ids living in hexid or in the ring of hexagons at distance contiguity"""
+        neighboring_hex_list = list(h3.k_ring_distances(hexid, contiguity)[contiguity])
+        return np.concatenate([self.users_in_hex(n_hexid) for n_hexid in [hexid] + neighboring_hex_list])
+
+    def home_of(self, uids):
+        """Home hexagons (as integers) of an array of user ids. 0 for users without home"""
+        uids = np.asarray(uids, dtype=np.int64)
+        if len(self.uids) == 0:
+            return np.zeros(len(uids), dtype=np.uint64)
+        positions = np.searchsorted(self.uids, uids).clip(0, len(self.uids) - 1)
+        found = self.uids[positions] == uids
+        return np.where(found, self.homes[positions], np.uint64(0))
+
+    def is_resident(self, uids, hexid):
+        """Boolean array, True for user ids living in hexid"""
+        return self.home_of(uids) == np.uint64(int(hexid, 16))
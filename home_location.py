@@ -2,13 +2,12 @@ __author__ = 'Ricardo Pasquini'
 
 #individual dataframe
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point, Polygon, shape
-import matplotlib.pyplot as plt
 import numpy as np
 from pymongo import InsertOne, UpdateOne
 import time
 from pymongo.errors import BulkWriteError
+from instrumentation import JobMetrics
+import dataaccess
 
 import os,sys,inspect
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -34,9 +33,15 @@ def df_to_gdf(input_df, crs=4326, lon='lon', lat='lat'):
     lon: name of longitude field
     lat: name of latitude field
     """
+    import geopandas as gpd
+    from shapely.geometry import Point
+
     df = input_df.copy()
 
-    geometry = [Point(xy) for xy in zip(df[lon], df[lat])]
+    if hasattr(gpd, 'points_from_xy'):  # geopandas>=0.5, points built from coordinate arrays
+        geometry = gpd.points_from_xy(df[lon], df[lat])
+    else:
+        geometry = [Point(xy) for xy in zip(df[lon], df[lat])]
     gdf = gpd.GeoDataFrame(df, crs=crs, geometry=geometry)
     # reproject
     gdf.crs = {'init': 'epsg:4326'}
@@ -64,215 +69,348 @@ def muestraprecisionproyeccionCABA():
 
 
 class Homelocation:
-    "Stores home location algorithm results"
+    """Stores home location algorithm results.
+    Only home and work coordinates are kept. The tweets of the user as a GeoDataFrame (gdfi) and the frequency table
+    of locations (freqdfi) are rebuilt from the tweets collection the first time they are used, so results of many
+    users can be held in memory"""
 
     # EL OUTPUT RELEVANTE ES ['distanciaatipica','distalcentroide_estandar','desvio_MEAN_distancias']
 
-    def __init__(self):
+    __slots__ = ('completed', 'reason', 'uid', 'method', 'dataformat', 'homecoordinates', 'workcoordinates',
+                 '_db', '_dfi', '_freqdfi', '_gdfi')
+
+    def __init__(self, db=None, uid=None, method='latlon', dataformat='raw'):
         self.completed = False
         self.reason = 'unknown'
-
-    def loadresults(self, gdfi, freqdfi, homecoordinates, workcoordinates):
-        self.gdfi = gdfi
-        self.freqdfi = freqdfi
+        self.uid = uid
+        self.method = method
+        self.dataformat = dataformat
+        self.homecoordinates = None
+        self.workcoordinates = None
+        self._db = db
+        self._dfi = None
+        self._freqdfi = None
+        self._gdfi = None
+
+    def loadresults(self, homecoordinates, workcoordinates, dfi=None, freqdfi=None):
+        """
+        :param dfi: optional tweets of the user, kept (otherwise read again when gdfi is used)
+        :param freqdfi: optional frequency table of locations, kept (otherwise rebuilt when used)
+        """
         self.homecoordinates = homecoordinates
         self.workcoordinates = workcoordinates
+        self._dfi = dfi
+        self._freqdfi = freqdfi
         self.completed = True
 
+    def _loadtables(self):
+        "Reads the tweets of the user and repeats findhome steps"
+        dfi = dataaccess.user_tweets(self._db, [self.uid], dataformat=self.dataformat)
+        self._dfi, self._freqdfi = home_and_work(dfi, method=self.method)[:2]
+
+    @property
+    def freqdfi(self):
+        """Frequency table of candidate locations, built the first time it is used"""
+        if self._freqdfi is None:
+            self._loadtables()
+        return self._freqdfi
+
+    @property
+    def gdfi(self):
+        """Tweets of the user as a GeoDataFrame projected to crs_ciudad. Built the first time it is used
+        (maps and tweetsfromhome/tweetsfromwork), home location itself does not need geometries"""
+        if self._gdfi is None:
+            if self._dfi is None:
+                self._loadtables()
+            self._gdfi = df_to_gdf(self._dfi, crs='+init=epsg:4326').to_crs(crs_ciudad)
+            self._dfi = None  # same columns are in gdfi
+        return self._gdfi
+
     def tweetsfromhome(self):
-        return self.gdfi[
-            (self.gdfi['latr'] == self.homecoordinates['latr']) & (self.gdfi['lonr'] == self.homecoordinates['lonr'])]
+        return self.gdfi[_at_location(self.gdfi, self.homecoordinates, self.method)]
 
     def tweetsfromwork(self):
-        return self.gdfi[
-            (self.gdfi['latr'] == self.workcoordinates['latr']) & (self.gdfi['lonr'] == self.workcoordinates['lonr'])]
+        if self.workcoordinates is None:  # single candidate location
+            return self.gdfi.iloc[:0]
+        return self.gdfi[_at_location(self.gdfi, self.workcoordinates, self.method)]
 
 
-def findhome(db, uid, method='latlon', map=True, dataformat='raw'):
+def home_and_work(dfi, method='latlon'):
     """
-    Finds home for user id.
+    Steps of findhome on the tweets of a user: adds time (and rounded coordinates) columns to the tweets, builds
+    the frequency table of locations and selects home and work among the candidate locations
 
-    :param db: mongo database connection
-    :param uid: user id
-    :return: Homelocation class element. Contains georeferenced tweets, frequency table and home coordinates
+    :param dfi: dataframe of tweets of a user (see dataaccess.user_tweets)
+    :return: dfi, freqdfi, homecoordinates and workcoordinates (None if there is a single candidate)
     """
-    dfi = pd.DataFrame(list(db.tweets.find({'u_id': uid})))
-    #print(dfi)
+    # 1. Adding relevant info to dfi
+    timestamp = created_at_to_datetime(dfi['created_at'])
+    dfi['hour'] = timestamp.dt.hour
+    # nighttime dummy
+    dfi['night'] = (dfi['hour'] < 7) | (dfi['hour'] > 22)
+    dfi['dayofweek'] = timestamp.dt.dayofweek
+    # dayofweekdummy
+    # Monday=0, Sunday=6. so weekend is 5 or 6
+    dfi['weekend'] = (dfi['dayofweek'] == 5) | (dfi['dayofweek'] == 6)
+
+    # 2. Frequency aggregation
 
-    if dataformat!='raw':
-        # si la data no esta en formato raw, es porque esta en formato geolocation de mongo, y entonces tengo que hacer el unfold
-        # in the new data it is necessary to unfold the json containing coordinates into columns
-        dfi = pd.concat([dfi, dfi.location.apply(lambda x: x['coordinates'][0]).rename('lon'),
-                         dfi.location.apply(lambda x: x['coordinates'][1]).rename('lat')], axis=1)
+    if method == 'hex9':
 
-    # Adding hex resolution 9 to dfi
-    dfi = pd.concat([dfi, dfi.hex.apply(lambda x: x['9']).rename('hex9')], axis=1)
+        spatialgroup = ["hex9"]
 
-    if dfi.shape[0] > 30:
+    else:  # method='latlon':
 
-        # 1. Adding relevant info to dfi
-        dfi['hour'] = pd.to_datetime(dfi['created_at'] // 1000, unit='s').dt.hour
-        # nighttime dummy
-        dfi['night'] = (dfi['hour'] < 7) | (dfi['hour'] > 22)
-        dfi['dayofweek'] = pd.to_datetime(dfi['created_at'] // 1000, unit='s').dt.dayofweek
-        # dayofweekdummy
-        # Monday=0, Sunday=6. so weekend is 5 or 6
-        dfi['weekend'] = (dfi['dayofweek'] == 5) | (dfi['dayofweek'] == 6)
+        # method='latlon' computes frequency on rounded coordinates
+        # this is a critical step, which imposes that coordinates precision in degress will be up to the second decimal (equivalent to 110 meters in CABA proyection)
+        rounded_coordinates = dfi[['lat', 'lon']].round({'lat': 2, 'lon': 2}).rename(
+            columns={'lat': 'latr', 'lon': 'lonr'})
+        dfi = pd.concat([dfi, rounded_coordinates], axis=1)
 
-        # 2. Frequency aggregation
+        spatialgroup = ["latr", "lonr"]
 
-        if method == 'hex9':
+    # freqdfi is dataframe at the location level aimed to counts tweets by location.
+    # stable sorts: ties are kept in location order
+    freqdfi = dfi.groupby(spatialgroup).size().reset_index(name="freq").sort_values(by=['freq'], ascending=False, kind='mergesort')
 
-            spatialgroup = ["hex9"]
+    #cambio esta linea porque quedo deprecada en versiones nuevas de pandas
+    #rangedfi = pd.concat([dfi.groupby(spatialgroup)['hour'].agg({'hourrange': lambda x: x.max() - x.min()})], axis=1)
 
-        else:  # method='latlon':
+    rangedfi = pd.DataFrame(dfi.groupby(spatialgroup)['hour'].agg( lambda x: x.max() - x.min())).rename(columns={'hour':'hourrange'})
 
-            # method='latlon' computes frequency on rounded coordinates
-            # this is a critical step, which imposes that coordinates precision in degress will be up to the second decimal (equivalent to 110 meters in CABA proyection)
-            rounded_coordinates = dfi[['lat', 'lon']].round({'lat': 2, 'lon': 2}).rename(
-                columns={'lat': 'latr', 'lon': 'lonr'})
-            dfi = pd.concat([dfi, rounded_coordinates], axis=1)
+    nightdf = dfi.loc[dfi['night'] == True].groupby(spatialgroup).size().reset_index(name="night_freq").sort_values(
+        by=["night_freq"], ascending=False)
 
-            spatialgroup = ["latr", "lonr"]
+    weekenddf = dfi.loc[dfi['weekend'] == True].groupby(spatialgroup).size().reset_index(
+        name="weekend_freq").sort_values(by=["weekend_freq"], ascending=False)
 
-        # freqdfi is dataframe at the location level aimed to counts tweets by location.
-        freqdfi = dfi.groupby(spatialgroup).size().reset_index(name="freq").sort_values(by=['freq'], ascending=False)
+    uniquehours = dfi.groupby(spatialgroup)['hour'].nunique().reset_index(name="uniquehours")
 
-        #cambio esta linea porque quedo deprecada en versiones nuevas de pandas
-        #rangedfi = pd.concat([dfi.groupby(spatialgroup)['hour'].agg({'hourrange': lambda x: x.max() - x.min()})], axis=1)
+    freqdfi = pd.merge(freqdfi, uniquehours, how='left', left_on=spatialgroup, right_on=spatialgroup)
+    freqdfi = pd.merge(freqdfi, rangedfi, how='left', left_on=spatialgroup, right_on=spatialgroup)
+    freqdfi = pd.merge(freqdfi, nightdf, how='left', left_on=spatialgroup, right_on=spatialgroup)
+    freqdfi = pd.merge(freqdfi, weekenddf, how='left', left_on=spatialgroup, right_on=spatialgroup)
 
-        rangedfi = pd.DataFrame(dfi.groupby('hex9')['hour'].agg( lambda x: x.max() - x.min())).rename(columns={'hour':'hourrange'})
+    freqdfi.loc[freqdfi['night_freq'].isna(), 'night_freq'] = 0
+    freqdfi.loc[freqdfi['weekend_freq'].isna(), 'weekend_freq'] = 0
 
-        nightdf = dfi.loc[dfi['night'] == True].groupby(spatialgroup).size().reset_index(name="night_freq").sort_values(
-            by=["night_freq"], ascending=False)
+    # Distances computation. In case the method is lat lon, it also retrieves distances between most frequent coordinate and the following
 
-        weekenddf = dfi.loc[dfi['weekend'] == True].groupby(spatialgroup).size().reset_index(
-            name="weekend_freq").sort_values(by=["weekend_freq"], ascending=False)
+    if method == 'latlon':
+        # on coordinate arrays, no geometries needed
+        freqdfi['distance'] = _coordinate_distances(freqdfi['latr'].to_numpy(), freqdfi['lonr'].to_numpy(),
+                                                    freqdfi['latr'].iloc[0], freqdfi['lonr'].iloc[0])
 
-        uniquehours = dfi.groupby(spatialgroup)['hour'].nunique().reset_index(name="uniquehours")
+    ############################################
+    # Candidates selection
 
-        freqdfi = pd.merge(freqdfi, uniquehours, how='left', left_on=spatialgroup, right_on=spatialgroup)
-        freqdfi = pd.merge(freqdfi, rangedfi, how='left', left_on=spatialgroup, right_on=spatialgroup)
-        freqdfi = pd.merge(freqdfi, nightdf, how='left', left_on=spatialgroup, right_on=spatialgroup)
-        freqdfi = pd.merge(freqdfi, weekenddf, how='left', left_on=spatialgroup, right_on=spatialgroup)
+    # 1) seleccion ubicaciones con una frecuencia atipicamente alta: el porcentaje de tweets es atipicamente alto.
 
-        freqdfi.loc[freqdfi['night_freq'].isna(), 'night_freq'] = 0
-        freqdfi.loc[freqdfi['weekend_freq'].isna(), 'weekend_freq'] = 0
+    # cuanta importancia representa en relacion a la ubicacion más frecuente
+    freqdfi['freqp1'] = freqdfi['freq'] / freqdfi['freq'].iloc[0]
 
-        # Distances computation. In case the method is lat lon, it also retrieves distances between most frequent coordinate and the following
+    freqdfi = freqdfi.loc[freqdfi['freqp1'] > 0.1]
 
-        if method == 'latlon':
-            freqdfi = df_to_gdf(freqdfi, lon='lonr', lat='latr')  # requires lat and lon coordinates
-            freqdfi['distance'] = [freqdfi.iloc[0].geometry.distance(freqdfi.iloc[i].geometry) * 11092.82 for i in
-                                   range(0, freqdfi.shape[0])]
+    ############################################
+    # Home location criteria
 
-        ############################################
-        # Candidates selection
+    # 2) entre estos, la casa es la que tiene alta frecuencia durante la noche y ademas el fin de semana
+    # el trabajo es el que no tiene frecuencia durante la noche y tiene frecuencia en el horario laboral.
 
-        # 1) seleccion ubicaciones con una frecuencia atipicamente alta: el porcentaje de tweets es atipicamente alto.
+    # pocentaje durante la noche
+    freqdfi['pnight_freq'] = freqdfi['night_freq'] / freqdfi['freq']
 
-        # cuanta importancia representa en relacion a la ubicacion más frecuente
-        freqdfi['freqp1'] = freqdfi['freq'] / freqdfi['freq'].iloc[0]
+    # porcentaje de fin de semana
+    freqdfi['pweekend_freq'] = freqdfi['weekend_freq'] / freqdfi['freq']
 
-        freqdfi = freqdfi.loc[freqdfi['freqp1'] > 0.1]
+    freqdfi['interactnightyweekend'] = freqdfi['pnight_freq'] * freqdfi['pweekend_freq']
 
-        ############################################
-        # Home location criteria
+    # busco la maxima
+    homecoordinates = freqdfi.sort_values(by=['interactnightyweekend'], ascending=False, kind='mergesort').iloc[0]
 
-        # 2) entre estos, la casa es la que tiene alta frecuencia durante la noche y ademas el fin de semana
-        # el trabajo es el que no tiene frecuencia durante la noche y tiene frecuencia en el horario laboral.
+    ############################################
+    # Work criteria
+    # work here is any place where the person goes frequently outside his/her home. Could be school, university etc
+    # between the candidate locations is the one that maximizes day and week
 
-        # pocentaje durante la noche
-        freqdfi['pnight_freq'] = freqdfi['night_freq'] / freqdfi['freq']
+    freqdfi['pday_freq'] = 1 - freqdfi['pnight_freq']
+    freqdfi['pweekday_freq'] = 1 - freqdfi['pweekend_freq']
+    freqdfi['interactdayyweekday'] = freqdfi['pday_freq'] * freqdfi['pweekday_freq']
 
-        # porcentaje de fin de semana
-        freqdfi['pweekend_freq'] = freqdfi['weekend_freq'] / freqdfi['freq']
+    # elimino la fila de homecoordinates y luego maximizo dia y weekday
+    try:
+        workcoordinates = \
+        freqdfi.drop([homecoordinates.name]).sort_values(by=['interactdayyweekday'], ascending=False, kind='mergesort').iloc[0]
+    except IndexError:
+        workcoordinates = None
 
-        freqdfi['interactnightyweekend'] = freqdfi['pnight_freq'] * freqdfi['pweekend_freq']
+    return dfi, freqdfi, homecoordinates, workcoordinates
 
-        # busco la maxima
-        homecoordinates = freqdfi.sort_values(by=['interactnightyweekend'], ascending=False).iloc[0]
 
-        ############################################
-        # Work criteria
-        # work here is any place where the person goes frequently outside his/her home. Could be school, university etc
-        # between the candidate locations is the one that maximizes day and week
+def findhome(db, uid, method='latlon', map=True, dataformat='raw', metrics=None):
+    """
+    Finds home for user id.
 
-        freqdfi['pday_freq'] = 1 - freqdfi['pnight_freq']
-        freqdfi['pweekday_freq'] = 1 - freqdfi['pweekend_freq']
-        freqdfi['interactdayyweekday'] = freqdfi['pday_freq'] * freqdfi['pweekday_freq']
+    :param db: mongo database connection
+    :param uid: user id
+    :param metrics: optional instrumentation.JobMetrics, times the read of the tweets as stage findhome.read
+    :return: Homelocation class element. Contains home and work coordinates (and lazily, georeferenced tweets and
+             frequency table)
+    """
+    readstart = time.perf_counter()
+    # only the fields used, as typed columns: u_id, lat, lon (also unfolded from mongo location field), hex9 and created_at
+    dfi = dataaccess.user_tweets(db, [uid], dataformat=dataformat)
+    if metrics is not None:
+        metrics.observe('findhome.read', time.perf_counter() - readstart)
 
-        # elimino la fila de homecoordinates y luego maximizo dia y weekday
-        try:
-            workcoordinates = \
-            freqdfi.drop([homecoordinates.name]).sort_values(by=['interactdayyweekday'], ascending=False).iloc[0]
-        except IndexError:
-            homeresults = Homelocation()
+    homeresults = Homelocation(db, uid, method=method, dataformat=dataformat)
+
+    if dfi.shape[0] > 30:
+
+        dfi, freqdfi, homecoordinates, workcoordinates = home_and_work(dfi, method=method)
+        if workcoordinates is None:
             homeresults.reason = 'No work coordinates'
             return homeresults
 
-        gdfi = df_to_gdf(dfi, crs='+init=epsg:4326')
-        gdfi = gdfi.to_crs(crs_ciudad)
-
         if map == True:
-            # plt.gca().patch.set_facecolor('white')
-            # plt.rcParams['figure.facecolor'] = 'white'
-            # fig = plt.figure()
-            # fig.patch.set_facecolor('white')
+            import matplotlib.pyplot as plt
+            homeresults.loadresults(homecoordinates, workcoordinates, dfi=dfi, freqdfi=freqdfi)
             plt.rcParams['figure.figsize'] = [10, 10]  # this sets the size of the figure
-
-            Provincia = gpd.read_file(currentdir+"/data/Provincia_2010.shp")
-            base = Provincia.to_crs(crs_ciudad).plot(markersize=6, color="gray", alpha=0.2, edgecolor='white',
-                                                     linewidth=4)
-
-            minx, miny, maxx, maxy = gdfi.total_bounds
-            minx = minx - 10000
-            miny = miny - 10000
-            maxx = maxx + 10000
-            maxy = maxy + 10000
-            base.set_xlim(minx, maxx)
-            base.set_ylim(miny, maxy)
-            # rdf.plot(ax=base,color='blue', markersize=5)
-
-            gdfi.plot(ax=base)
+            plot_homelocation(homeresults)
 
             print('Home in red')
             print('Notice than more than one point might result in red due to coordinates precision')
 
-            gdfi[(gdfi['latr'] == homecoordinates['latr']) & (gdfi['lonr'] == homecoordinates['lonr'])].plot(ax=base,
-                                                                                                         color='red')
-
             # mapping points with home coordinates
+            gdfi = homeresults.gdfi
             gdfi['home'] = 0
-            gdfi.loc[(gdfi['latr'] == homecoordinates['latr']) & (gdfi['lonr'] == homecoordinates['lonr']), 'home'] = 1
+            gdfi.loc[_at_location(gdfi, homecoordinates, method), 'home'] = 1
 
-        homeresults = Homelocation()
-        homeresults.loadresults(gdfi, freqdfi, homecoordinates, workcoordinates)
+        else:
+            homeresults.loadresults(homecoordinates, workcoordinates)
 
     else:
 
-        homeresults = Homelocation()
         homeresults.reason = 'less than 30 tweets'
 
     return homeresults
 
 
+# Provincia basemap reprojected to crs_ciudad, read from disk on first use (see provincia_basemap)
+_provincia = None
+
+
+def provincia_basemap():
+    """Provincia_2010 shapefile projected to crs_ciudad. Read and reprojected once, later calls reuse it"""
+    global _provincia
+    if _provincia is None:
+        import geopandas as gpd
+        _provincia = gpd.read_file(currentdir+"/data/Provincia_2010.shp").to_crs(crs_ciudad)
+    return _provincia
+
+
+def plot_basemap(ax=None):
+    "Plots the cached Provincia basemap, in a new axis or in ax"
+    return provincia_basemap().plot(ax=ax, markersize=6, color="gray", alpha=0.2, edgecolor='white', linewidth=4)
+
+
+def _at_location(gdfi, coordinates, method='latlon'):
+    "Tweets at a location of the frequency table (rounded coordinates or hex9, depending on method)"
+    if method == 'hex9':
+        return gdfi['hex9'] == coordinates['hex9']
+    return (gdfi['latr'] == coordinates['latr']) & (gdfi['lonr'] == coordinates['lonr'])
+
+
+def _set_bounds(ax, gdf, margin=10000):
+    "Zooms ax to the bounds of gdf plus a margin in meters"
+    minx, miny, maxx, maxy = gdf.total_bounds
+    ax.set_xlim(minx - margin, maxx + margin)
+    ax.set_ylim(miny - margin, maxy + margin)
+
+
+def plot_homelocation(homeresults, ax=None, basemap=True, work=False, margin=10000):
+    """
+    Maps the tweets of a user with home in red
+
+    :param homeresults: completed Homelocation (see findhome)
+    :param ax: optional axis to plot in, for instance an axis that already has the basemap
+    :param basemap: plot the Provincia basemap first
+    :param work: also plot work in green
+    :param margin: meters around the tweets of the user
+    :return: axis
+    """
+    if basemap:
+        ax = plot_basemap(ax)
+    gdfi = homeresults.gdfi
+    _set_bounds(ax, gdfi, margin=margin)
+
+    gdfi.plot(ax=ax)
+    gdfi[_at_location(gdfi, homeresults.homecoordinates, homeresults.method)].plot(ax=ax, color='red')
+    if work:
+        gdfi[_at_location(gdfi, homeresults.workcoordinates, homeresults.method)].plot(ax=ax, color='green')
+    return ax
+
+
+def plot_homelocations(results, tiled=False, ncols=4, size=5, margin=10000):
+    """
+    Maps home location results of many users, plotting the cached basemap once per axis
+
+    :param results: list of Homelocation (see findhome). Results not completed are skipped
+    :param tiled: False plots all users in a single map (tweets in blue, home in red and work in green),
+                  True plots a grid of maps, one per user
+    :param ncols: number of columns of the grid
+    :param size: size in inches of each map
+    :return: figure
+    """
+    import geopandas as gpd
+    import matplotlib.pyplot as plt
 
-def timeofdayplot(db,uid):
+    results = [result for result in results if result.completed]
+    if len(results) == 0:
+        raise ValueError('no completed home location results to plot')
+
+    if tiled:
+        nrows = int(np.ceil(len(results) / ncols))
+        fig, axes = plt.subplots(nrows, ncols, figsize=(size * ncols, size * nrows), squeeze=False)
+        for ax, result in zip(axes.ravel(), results):
+            plot_homelocation(result, ax=ax, work=True, margin=margin)
+            ax.set_title(str(result.uid))
+        for ax in axes.ravel()[len(results):]:
+            ax.axis('off')
+        return fig
+
+    fig, ax = plt.subplots(figsize=(2 * size, 2 * size))
+    plot_basemap(ax)
+    tweets = []
+    for result in results:
+        gdfi = result.gdfi
+        place = np.where(_at_location(gdfi, result.homecoordinates, result.method), 'home',
+                         np.where(_at_location(gdfi, result.workcoordinates, result.method), 'work', 'other'))
+        tweets.append(gpd.GeoDataFrame({'place': place}, geometry=gdfi.geometry.values, crs=gdfi.crs))
+    tweets = pd.concat(tweets, ignore_index=True)
+
+    # a plot call for each kind of place, for all users
+    for place, color in [('other', None), ('home', 'red'), ('work', 'green')]:
+        if (tweets['place'] == place).any():
+            tweets.loc[tweets['place'] == place].plot(ax=ax, color=color)
+    _set_bounds(ax, tweets, margin=margin)
+    return fig
+
+
+def timeofdayplot(db, uid, dataformat='location'):
     """
     Plots coordinates to time of day
     :param db:
     :param uid:
+    :param dataformat: coordinates are read from mongo location field by default, 'raw' reads lat and lon fields
     :return:
     """
     import matplotlib.pyplot as plt
     plt.rcParams['figure.figsize'] = [5, 5] #this sets the size of the figure
 
-    dfi=pd.DataFrame(list(db.tweets.find({'u_id':uid})))
-    dfi = pd.concat([dfi, dfi.location.apply(lambda x: x['coordinates'][0]).rename('lon'),
-                     dfi.location.apply(lambda x: x['coordinates'][1]).rename('lat')], axis=1)
-    dfi['hour']=pd.to_datetime(dfi['created_at'] // 1000, unit='s').dt.hour
-    x=pd.to_datetime(dfi['created_at'] // 1000, unit='s').dt.hour
+    dfi=dataaccess.user_tweets(db, [uid], dataformat=dataformat)
+    dfi['hour']=created_at_to_datetime(dfi['created_at']).dt.hour
+    x=dfi['hour']
     lat=dfi.lat
     plt.scatter(x,lat)
     plt.xlabel('hour', fontsize=16)
@@ -294,6 +432,214 @@ def timeofdayplot(db,uid):
     plt.show()
 
 
+##########Batch home location engine
+# Same algorithm as findhome, but computed for many users at once with grouped numpy operations.
+
+def created_at_to_datetime(created_at):
+    """
+    Converts created_at field to datetimes
+
+    :param created_at: milliseconds since epoch (raw data), datetimes or both mixed (see dataaccess.dates_array)
+    :return: datetime series
+    """
+    created_at = pd.Series(created_at)
+    if np.issubdtype(created_at.dtype, np.datetime64):  # if data is already timestamped then just copy
+        return created_at
+    return pd.Series(dataaccess.dates_array(created_at.to_numpy(), truncate=True), index=created_at.index,
+                     name=created_at.name)
+
+
+def _spatialgroup(method):
+    "Columns defining a location for each home location method"
+    if method == 'hex9':
+        return ['hex9']
+    return ['latr', 'lonr']
+
+
+def _coordinate_distances(latr, lonr, lat0, lon0):
+    """Distances (in meters) between rounded coordinates, computed as in findhome:
+    euclidean distance in degrees times 11092.82"""
+    return np.sqrt((lonr - lon0) ** 2 + (latr - lat0) ** 2) * 11092.82
+
+
+def _group_starts(codes):
+    "Positions where a new group starts in an array of sorted group codes"
+    newgroup = np.ones(len(codes), dtype=bool)
+    newgroup[1:] = codes[1:] != codes[:-1]
+    return np.flatnonzero(newgroup)
+
+
+def _first_max_in_groups(values, starts):
+    "Position of the first maximum of values within each group of contiguous rows"
+    lengths = np.diff(np.append(starts, len(values)))
+    groupmax = np.maximum.reduceat(values, starts)
+    rows = np.flatnonzero(values == np.repeat(groupmax, lengths))
+    groupofrow = np.repeat(np.arange(len(starts)), lengths)
+    _, first = np.unique(groupofrow[rows], return_index=True)
+    return rows[first]
+
+
+def _count_bits(bitmaps):
+    "Number of bits set in each element of an array of 32 bits bitmaps"
+    bytes_ = np.asarray(bitmaps, dtype='>u4').view(np.uint8).reshape(-1, 4)
+    return np.unpackbits(bytes_, axis=1).sum(axis=1).astype(np.int64)
+
+
+def location_statistics(df, method='latlon'):
+    """
+    Tweet statistics at the user and location level, for many users at once
+
+    :param df: columnar table of tweets with u_id, lat, lon, hex9 and created_at columns
+    :param method: 'hex9' or 'latlon', as in findhome
+    :return: dataframe with a row per user and location, with freq, night_freq, weekend_freq,
+             hours (bitmap of the hours of the day with tweets), minhour and maxhour
+    """
+    spatialgroup = _spatialgroup(method)
+    keycolumns = ['u_id'] + spatialgroup
+    statscolumns = ['freq', 'night_freq', 'weekend_freq', 'hours', 'minhour', 'maxhour']
+    if df.shape[0] == 0:
+        return pd.DataFrame(columns=keycolumns + statscolumns)
+
+    keys = {'u_id': df['u_id'].to_numpy()}
+    if method == 'hex9':
+        keys['hex9'] = df['hex9'].to_numpy()
+    else:
+        # same rounding as findhome: coordinates precision up to the second decimal
+        keys['latr'] = np.round(df['lat'].to_numpy(dtype=np.float64), 2)
+        keys['lonr'] = np.round(df['lon'].to_numpy(dtype=np.float64), 2)
+
+    # sort tweets by user and location, and find where each group starts
+    keycodes = [pd.factorize(keys[col], sort=True)[0] for col in keycolumns]
+    order = np.lexsort(keycodes[::-1])
+    newgroup = np.zeros(len(order), dtype=bool)
+    newgroup[0] = True
+    for codes in keycodes:
+        codes = codes[order]
+        newgroup[1:] |= codes[1:] != codes[:-1]
+    starts = np.flatnonzero(newgroup)
+
+    timestamp = created_at_to_datetime(df['created_at'])
+    hour = timestamp.dt.hour.to_numpy().astype(np.int64)[order]
+    dayofweek = timestamp.dt.dayofweek.to_numpy()[order]
+    # nighttime and weekend dummies. Monday=0, Sunday=6. so weekend is 5 or 6
+    night = (hour < 7) | (hour > 22)
+    weekend = (dayofweek == 5) | (dayofweek == 6)
+
+    stats = pd.DataFrame({col: keys[col][order][starts] for col in keycolumns})
+    stats['freq'] = np.diff(np.append(starts, len(order)))
+    stats['night_freq'] = np.add.reduceat(night.astype(np.int64), starts)
+    stats['weekend_freq'] = np.add.reduceat(weekend.astype(np.int64), starts)
+    stats['hours'] = np.bitwise_or.reduceat(np.left_shift(1, hour), starts)
+    stats['minhour'] = np.minimum.reduceat(hour, starts)
+    stats['maxhour'] = np.maximum.reduceat(hour, starts)
+
+    return stats
+
+
+class BatchHomelocation:
+    "Stores home location algorithm results for many users"
+
+    def __init__(self, freqdf, homes, works, reasons, method):
+        self.freqdf = freqdf  # candidate locations of all users
+        self.homes = homes  # home coordinates indexed by u_id
+        self.works = works  # work coordinates indexed by u_id
+        self.reasons = reasons  # reason of users without results, indexed by u_id
+        self.method = method
+
+    def completed(self, uid):
+        return uid in self.homes.index
+
+    def reason(self, uid):
+        if self.completed(uid):
+            return 'unknown'
+        # users without tweets in the table never reach the 30 tweets threshold
+        return self.reasons.get(uid, 'less than 30 tweets')
+
+    def dicttopopulate(self, uid):
+        "Document to populate in users collection for user id, the same findhomeandpopulate writes"
+        if self.completed(uid):
+            return homecoordinates_to_dict(self.homes.loc[uid], self.method)
+        return {'foundhome': False, 'foundhomereason': self.reason(uid)}
+
+
+def select_home_and_work(stats, method='latlon'):
+    """
+    Home and work selection for many users at once. Applies findhome criteria to location statistics
+
+    :param stats: location statistics, as returned by location_statistics
+    :param method: 'hex9' or 'latlon'
+    :return: BatchHomelocation
+    """
+    spatialgroup = _spatialgroup(method)
+    stats = stats.reset_index(drop=True)
+
+    # users with less than 30 tweets are left out
+    totaltweets = stats.groupby('u_id')['freq'].transform('sum')
+    reasons = pd.Series('less than 30 tweets', index=stats.loc[totaltweets <= 30, 'u_id'].unique())
+    stats = stats.loc[totaltweets > 30]
+
+    # sort locations of each user by frequency. Ties are kept in location order, as in findhome
+    ucodes = pd.factorize(stats['u_id'], sort=True)[0]
+    keycodes = [pd.factorize(stats[col], sort=True)[0] for col in spatialgroup]
+    order = np.lexsort(tuple(keycodes[::-1]) + (-stats['freq'].to_numpy(), ucodes))
+    freqdf = stats.iloc[order].reset_index(drop=True)
+    starts = _group_starts(ucodes[order])
+    lengths = np.diff(np.append(starts, freqdf.shape[0]))
+
+    freq = freqdf['freq'].to_numpy(dtype=np.int64)
+    freqdf = freqdf[['u_id'] + spatialgroup + ['freq']].assign(
+        uniquehours=_count_bits(freqdf['hours']),
+        hourrange=(freqdf['maxhour'] - freqdf['minhour']).to_numpy(dtype=np.int64),
+        night_freq=freqdf['night_freq'].to_numpy(dtype=np.float64),
+        weekend_freq=freqdf['weekend_freq'].to_numpy(dtype=np.float64))
+
+    if method == 'latlon':
+        # distances between most frequent coordinate and the following
+        latr = freqdf['latr'].to_numpy(dtype=np.float64)
+        lonr = freqdf['lonr'].to_numpy(dtype=np.float64)
+        freqdf['distance'] = _coordinate_distances(latr, lonr, np.repeat(latr[starts], lengths),
+                                                   np.repeat(lonr[starts], lengths))
+
+    # 1) candidates: locations with a high frequency relative to the most frequent location
+    freqdf['freqp1'] = freq / np.repeat(freq[starts], lengths)
+    freqdf = freqdf.loc[freqdf['freqp1'] > 0.1].reset_index(drop=True)
+    starts = _group_starts(pd.factorize(freqdf['u_id'])[0])
+    lengths = np.diff(np.append(starts, freqdf.shape[0]))
+
+    # 2) home: maximizes night and weekend frequency
+    freqdf['pnight_freq'] = freqdf['night_freq'] / freqdf['freq']
+    freqdf['pweekend_freq'] = freqdf['weekend_freq'] / freqdf['freq']
+    freqdf['interactnightyweekend'] = freqdf['pnight_freq'] * freqdf['pweekend_freq']
+    homerows = _first_max_in_groups(freqdf['interactnightyweekend'].to_numpy(), starts)
+    homes = freqdf.iloc[homerows].set_index('u_id')
+
+    # 3) work: between the other candidates, maximizes day and weekday frequency
+    freqdf['pday_freq'] = 1 - freqdf['pnight_freq']
+    freqdf['pweekday_freq'] = 1 - freqdf['pweekend_freq']
+    freqdf['interactdayyweekday'] = freqdf['pday_freq'] * freqdf['pweekday_freq']
+    workvalues = freqdf['interactdayyweekday'].to_numpy().copy()
+    workvalues[homerows] = -np.inf
+    workrows = _first_max_in_groups(workvalues, starts)
+
+    withwork = lengths > 1
+    reasons = pd.concat([reasons, pd.Series('No work coordinates', index=homes.index[~withwork])])
+    homes = homes.loc[withwork]
+    works = freqdf.iloc[workrows[withwork]].set_index('u_id')
+
+    return BatchHomelocation(freqdf, homes, works, reasons, method)
+
+
+def findhome_batch(df, method='latlon'):
+    """
+    Finds home for all users in a table of tweets. Results match findhome for each user
+
+    :param df: columnar table of tweets with u_id, lat, lon, hex9 and created_at columns (see tweets_table_for_users)
+    :param method: 'hex9' or 'latlon'
+    :return: BatchHomelocation
+    """
+    return select_home_and_work(location_statistics(df, method=method), method=method)
+
+
 ##########The following are db related functions and the iteration jobs
 
 def updatehomelocation(db, uid, homedata):
@@ -337,58 +683,49 @@ def correct_encoding(dictionary):
 
     return new
 
-def findhomeandpopulate(uid, db, method='latlon', populate=True):
+def homecoordinates_to_dict(homecoordinates, method='latlon'):
+    "Prepares home coordinates (a row of the frequency table) as the document to populate in users collection"
+
+    homedata = homecoordinates.to_dict()
+
+    if method == 'latlon':  # only w/homelocation latlon method delete geometry field
+        homedata.pop('geometry', None)
+        homedata = correct_encoding(homedata)
+        homedata2 = homedata.copy()
+        del homedata2['latr']
+        del homedata2['lonr']
+        return {'foundhome':True, 'home': {'home_stats': homedata2, 'location': {'type': "Point",
+                                                    'coordinates': [homedata['lonr'], homedata['latr']]}}}
+
+    if method == 'hex9':
+        homedata = correct_encoding(homedata)
+        return {'hex9': homedata, 'foundhome':True}
+
+
+def findhomeandpopulate(uid, db, method='latlon', populate=True, metrics=None):
 
     "Find home for user id and populate users with result function"
 
     if method == 'hex9':
-        result = findhome(db=db, uid=uid, method='hex9', map=False)
+        result = findhome(db=db, uid=uid, method='hex9', map=False, metrics=metrics)
     else:
-        result = findhome(db=db, uid=uid, map=False)
+        result = findhome(db=db, uid=uid, map=False, metrics=metrics)
 
     #print(result.completed)
     if result.completed is not False:
-        homedata = result.homecoordinates.to_dict()
-
-        if method == 'latlon':  # only w/homelocation latlon method delete geometry field
-            del homedata['geometry']
-            homedata = correct_encoding(homedata)
-            homedata2 = homedata.copy()
-            del homedata2['latr']
-            del homedata2['lonr']
-            dicttopopulate = {'foundhome':True, 'home': {'home_stats': homedata2, 'location': {'type': "Point",
-                                                        'coordinates': [homedata['lonr'], homedata['latr']]}}}
-            if populate:
-                updatehomelocation(db=db, uid=uid, homedata=dicttopopulate)
-            else:
-                return dicttopopulate
-            # print(dicttopopulate)
-
-        if method == 'hex9':
-            homedata = correct_encoding(homedata)
-            dicttopopulate = {'hex9': homedata, 'foundhome':True}
-            #print(dicttopopulate)
-            if populate:
-                updatehomelocation(db=db, uid=uid, homedata=dicttopopulate)
-            else:
-                return dicttopopulate
-
-
-
+        dicttopopulate = homecoordinates_to_dict(result.homecoordinates, method=method)
 
     else: #result.completed is False
         dicttopopulate={'foundhome':result.completed, 'foundhomereason':result.reason}
-        if populate:
-            home.updatehomelocation(db=db, uid=uid, homedata=dicttopopulate)
-        else:
-            return dicttopopulate
-
-
 
+    if populate:
+        updatehomelocation(db=db, uid=uid, homedata=dicttopopulate)
+    else:
+        return dicttopopulate
 
 
 
-def job_findhomeandpopulate_hex9(db):
+def job_findhomeandpopulate_hex9(db, metrics=None):
 
     """
     Iteration over all users that do not have foundhome field
@@ -396,54 +733,369 @@ def job_findhomeandpopulate_hex9(db):
 
     Find home and populate hex9
     nusers: number of users in the bulk write process
+    metrics: optional instrumentation.JobMetrics. Times pending users query, findhome (findhome.read is the part
+             reading tweets) and write stages
 
     """
 
     nusers=50
 
-    lasttime=time.time()
-
     import warnings
     warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
 
     number_of_pending_users_to_process=db.users.count_documents({'foundhome': { '$exists': False } })
+    if metrics is None:
+        metrics = JobMetrics('job_findhomeandpopulate_hex9', total=number_of_pending_users_to_process, unit='users')
 
     while number_of_pending_users_to_process>0:
 
-        print('Pending users to process...', number_of_pending_users_to_process)
-
-        # note limit used for efficiency
-        cursorpendientes=db.users.find( { 'foundhome': { '$exists': False } } ).limit(nusers)
+        with metrics.stage('pending'):
+            # note limit used for efficiency
+            cursorpendientes=list(db.users.find( { 'foundhome': { '$exists': False } }, {'_id': 0, 'u_id': 1} ).limit(nusers))
 
-        #j=1
         requests=[]
         for doc in cursorpendientes:
             uid=doc['u_id']
-            dicttopopulate=findhomeandpopulate(uid=uid, db=db, method='hex9', populate=False)
+            with metrics.stage('findhome'):
+                dicttopopulate=findhomeandpopulate(uid=uid, db=db, method='hex9', populate=False, metrics=metrics)
             requests.append(UpdateOne({'u_id': uid}, {'$set': dicttopopulate}))
+            metrics.count('foundhome' if dicttopopulate['foundhome'] else 'notfoundhome')
+
+
+        with metrics.stage('write'):
+            try:
+                db.users.bulk_write(requests, ordered=False)
+            except BulkWriteError as bwe:
+                print(bwe.details)
+                metrics.count('bulkwriteerrors')
+
+        with metrics.stage('pending'):
+            number_of_pending_users_to_process=db.users.count_documents({'foundhome': { '$exists': False } })
+        metrics.progress(len(requests), pending=number_of_pending_users_to_process)
+
+    metrics.close()
+
+
+def findhome_in_uid_range(db, lowuid, highuid, method='hex9'):
+    """
+    Finds home for pending users (without foundhome field) with u_id between lowuid and highuid
+
+    :return: list of (uid, dicttopopulate)
+    """
+    cursor = db.users.find({'u_id': {'$gte': lowuid, '$lte': highuid}, 'foundhome': {'$exists': False}},
+                           {'_id': 0, 'u_id': 1})
+    return [(doc['u_id'], findhomeandpopulate(uid=doc['u_id'], db=db, method=method, populate=False)) for doc in cursor]
+
+
+# connection of each worker process of job_findhomeandpopulate_parallel
+_workerdb = None
+
+def _init_findhome_worker(database, clientoptions=None):
+    "Opens a connection in each worker process (clients of the parent process can not be used after a fork)"
+    global _workerdb
+    import warnings
+    warnings.simplefilter(action='ignore', category=FutureWarning)
+    import communicationwmongo as commu
+    _workerdb = commu.connecttoLocaldb(database=database, **(clientoptions or {}))
+
+
+def _findhome_worker(task):
+    "Runs findhome_in_uid_range in a worker process and reports throughput"
+    lowuid, highuid, method = task
+    starttime = time.time()
+    results = findhome_in_uid_range(_workerdb, lowuid, highuid, method=method)
+    stats = {'pid': os.getpid(), 'users': len(results), 'seconds': time.time() - starttime}
+    return lowuid, highuid, results, stats
+
+
+def job_findhomeandpopulate_parallel(db, nworkers=None, rangesize=500, method='hex9', progresscollection='jobprogress',
+                                     clientoptions=None):
+
+    """
+    Parallel version of job_findhomeandpopulate_hex9.
+    Pending users are read once and their u_id space is split in ranges of rangesize users. Each range is processed
+    by findhomeandpopulate in a pool of worker processes, each with its own database connection.
+    Results of each range are merged into a single bulk write.
+
+    The job is resumable: only users without foundhome field are processed, and each finished range is recorded
+    (with its throughput) in progresscollection.
+
+    :param db: mongo database connection
+    :param nworkers: number of worker processes. Default is the number of cores
+    :param rangesize: number of users in each range
+    :param method: home location method, 'hex9' or 'latlon'
+    :param clientoptions: communicationwmongo.get_client settings of the workers connections. By default workers
+                          open the same connection as db (host or uri, credentials, replica set, tls... see
+                          communicationwmongo.client_settings), with a pool of 2 connections as each worker runs one
+                          query at a time. Settings given here take precedence. Required (with at least host) if the
+                          client of db was not created by communicationwmongo.get_client
+    """
+    import multiprocessing
+    import communicationwmongo as commu
+
+    # the connection can not be rebuilt from db.client.address, which has no credentials nor other client options
+    settings = commu.client_settings(db.client)
+    if settings is None and 'host' not in (clientoptions or {}):
+        raise ValueError('workers can not open the connection of db, it was not created by '
+                         'communicationwmongo.get_client. Pass clientoptions with the host (mongodb:// uri) and '
+                         'options of the connection')
+    clientoptions = dict(dict(settings or {}, maxPoolSize=2), **(clientoptions or {}))
+
+    jobname = 'findhome_' + method
+    starttime = time.time()
+
+    previous = list(db[progresscollection].find({'job': jobname}, {'_id': 0, 'users': 1}))
+    if len(previous) > 0:
+        print('Resuming job. Users processed in previous runs:', sum(doc['users'] for doc in previous))
+
+    pendinguids = [doc['u_id'] for doc in
+                   db.users.find({'foundhome': {'$exists': False}}, {'_id': 0, 'u_id': 1}).sort('u_id', 1)]
+    number_of_pending_users_to_process = len(pendinguids)
+    print('Pending users to process...', number_of_pending_users_to_process)
+
+    tasks = [(pendinguids[i], pendinguids[min(i + rangesize, number_of_pending_users_to_process) - 1], method)
+             for i in range(0, number_of_pending_users_to_process, rangesize)]
+
+    workerstats = {}
+    processedusers = 0
+    with multiprocessing.Pool(nworkers, initializer=_init_findhome_worker, initargs=(db.name, clientoptions)) as pool:
+        for lowuid, highuid, results, stats in pool.imap_unordered(_findhome_worker, tasks):
+
+            requests = [UpdateOne({'u_id': uid}, {'$set': dicttopopulate}) for uid, dicttopopulate in results]
+            if len(requests) > 0:
+                try:
+                    db.users.bulk_write(requests, ordered=False)
+                except BulkWriteError as bwe:
+                    print(bwe.details)
+                    continue
+
+            db[progresscollection].insert_one({'job': jobname, 'range': [lowuid, highuid], 'pid': stats['pid'],
+                                               'users': stats['users'], 'seconds': stats['seconds']})
+
+            pidstats = workerstats.setdefault(stats['pid'], {'users': 0, 'seconds': 0.0})
+            pidstats['users'] += stats['users']
+            pidstats['seconds'] += stats['seconds']
+            processedusers += stats['users']
+            print('range', lowuid, '-', highuid, 'worker', stats['pid'], 'users/sec',
+                  stats['users'] / max(stats['seconds'], 1e-9), 'pending',
+                  number_of_pending_users_to_process - processedusers)
+
+    for pid, pidstats in workerstats.items():
+        print('worker', pid, 'users:', pidstats['users'], 'users/sec:', pidstats['users'] / max(pidstats['seconds'], 1e-9))
+    print('total users:', processedusers, 'total elapsed time:', time.time() - starttime)
+
+
+def tweets_table_for_users(db, uids, dataformat='raw'):
+    """
+    Retrieves tweets of a list of users with a single query, as a columnar table for findhome_batch
+
+    :param uids: list of user ids
+    :param dataformat: 'raw' if coordinates are in lat and lon fields, otherwise read from mongo location field
+    :return: dataframe with u_id, lat, lon, hex9 and created_at columns
+    """
+    return dataaccess.user_tweets(db, uids, dataformat=dataformat)
+
+
+def _tweets_table_fields(dataformat='raw'):
+    "Columns and field paths of the tweets fields used by the batch home location engine (see dataaccess.read_columns)"
+    fields = {'u_id': 'u_id'}
+    fields.update(dataaccess.coordinate_fields(dataformat))
+    fields.update({'hex9': 'hex.9', 'created_at': 'created_at'})
+    return fields
+
 
-            #if (j/20).is_integer(): #printing each 10 documents
-            #    print('iter:',j)
-            #j=j+1
+def tweets_table(db, query, dataformat='raw', withid=False, **kwargs):
+    """
+    Columnar table of the tweets matching a query
+
+    :param withid: also returns the _id column
+    :param kwargs: dataaccess.read_columns parameters (sort, limit...)
+    :return: dataframe with u_id, lat, lon, hex9 and created_at columns
+    """
+    fields = _tweets_table_fields(dataformat)
+    if withid:
+        fields['_id'] = '_id'
+    return dataaccess.read_columns(db.tweets, query, fields, **kwargs)
 
 
+def job_findhomeandpopulate_batch(db, method='hex9', nusers=5000, dataformat='raw'):
+
+    """
+    Batch version of job_findhomeandpopulate_hex9.
+    Iteration over all users that do not have foundhome field, nusers at a time.
+    Tweets of each group of users are read with a single query and homes are found with findhome_batch
+
+    nusers: number of users in the bulk write process
+
+    """
+
+    lasttime=time.time()
+
+    uids=[doc['u_id'] for doc in db.users.find({'foundhome': {'$exists': False}}, {'_id': 0, 'u_id': 1}).limit(nusers)]
+
+    while len(uids)>0:
+
+        results=findhome_batch(tweets_table_for_users(db, uids, dataformat=dataformat), method=method)
+
+        requests=[UpdateOne({'u_id': uid}, {'$set': results.dicttopopulate(uid)}) for uid in uids]
+
         try:
             db.users.bulk_write(requests, ordered=False)
             print('bulk write ok')
-            print('total time per user', (time.time()-lasttime)/nusers)
+            print('total time per user', (time.time()-lasttime)/len(uids))
             lasttime=time.time()
 
-
         except BulkWriteError as bwe:
             print(bwe.details)
 
+        uids=[doc['u_id'] for doc in db.users.find({'foundhome': {'$exists': False}}, {'_id': 0, 'u_id': 1}).limit(nusers)]
 
 
-        number_of_pending_users_to_process=db.users.count_documents({'foundhome': { '$exists': False } })
+##########Incremental home location from location statistics
+# Location statistics of each user are sufficient to apply findhome criteria (see select_home_and_work), and they
+# can be updated with new tweets without reading previous ones.
 
+def location_statistics_updates(stats, method='hex9'):
+    """
+    Update operations that add location statistics of new tweets to the ones stored in the statistics collection
 
+    :param stats: location statistics, as returned by location_statistics
+    :return: list of UpdateOne
+    """
+    spatialgroup = _spatialgroup(method)
+    listofupdates = []
+    for row in stats.itertuples(index=False):
+        key = {'u_id': int(row.u_id), 'method': method}
+        key.update({col: (getattr(row, col) if method == 'hex9' else float(getattr(row, col))) for col in spatialgroup})
+        listofupdates.append(UpdateOne(key, {'$inc': {'freq': int(row.freq), 'night_freq': int(row.night_freq),
+                                                      'weekend_freq': int(row.weekend_freq)},
+                                             '$bit': {'hours': {'or': int(row.hours)}},
+                                             '$min': {'minhour': int(row.minhour)},
+                                             '$max': {'maxhour': int(row.maxhour)},
+                                             '$set': {'pending': True}}, upsert=True))
+    return listofupdates
+
+
+def update_location_statistics(db, df, method='hex9', statscollection='locationstats', sizeofchunk=10000):
+    """
+    Adds tweets to the location statistics of their users
 
+    :param df: columnar table of new tweets (see tweets_table)
+    :return: array of user ids with updated statistics
+    """
+    stats = location_statistics(df, method=method)
+    listofupdates = location_statistics_updates(stats, method=method)
+    for i in range(0, len(listofupdates), sizeofchunk):
+        db[statscollection].bulk_write(listofupdates[i:i + sizeofchunk], ordered=False)
+    return stats['u_id'].unique()
 
 
+def location_statistics_from_db(db, uids, method='hex9', statscollection='locationstats'):
+    """
+    Reads stored location statistics of a list of users
+
+    :return: dataframe with the same columns as location_statistics
+    """
+    spatialgroup = _spatialgroup(method)
+    columns = ['u_id'] + spatialgroup + ['freq', 'night_freq', 'weekend_freq', 'hours', 'minhour', 'maxhour']
+    docs = list(db[statscollection].find({'u_id': {'$in': [int(uid) for uid in uids]}, 'method': method},
+                                         {col: 1 for col in columns}))
+    stats = pd.DataFrame({col: [doc[col] for doc in docs] for col in columns}, columns=columns)
+    for col in ['freq', 'night_freq', 'weekend_freq', 'hours', 'minhour', 'maxhour']:
+        stats[col] = stats[col].to_numpy(dtype=np.int64)
+    return stats
+
+
+def findhome_from_statistics(db, uids, method='hex9', statscollection='locationstats'):
+    """
+    Finds home for a list of users from their stored location statistics, without reading their tweets
+
+    :return: BatchHomelocation
+    """
+    return select_home_and_work(location_statistics_from_db(db, uids, method=method, statscollection=statscollection),
+                                method=method)
+
+
+def job_updatehomes_incremental(db, method='hex9', dataformat='raw', chunksize=100000, nusers=5000,
+                                statscollection='locationstats', progresscollection='jobprogress'):
+
+    """
+    Incremental version of job_findhomeandpopulate_batch.
+    Tweets inserted since the previous run (with _id above the high-water mark stored in progresscollection) are added
+    to the location statistics of their users ($inc, $bit, $min and $max updates). Then home and work of these users
+    are found again from their statistics, so the cost of each run depends on the new tweets only.
+
+    The first run reads all tweets. Users collection is updated as findhomeandpopulate does. Statistics of users
+    whose home was not updated yet are marked as pending, so an interrupted run is completed by the next one.
+    Each chunk of tweets is stored as pending in the progress document while it is added to the statistics, and the
+    high-water mark is advanced after its writes succeeded. Statistics are rebuilt from all tweets if a run finds a
+    pending chunk (a failed or interrupted write leaves them partially updated).
+
+    :param chunksize: number of tweets read and added to statistics at a time
+    :param nusers: number of users in the users bulk write process
+    """
+    starttime = time.time()
+    jobname = statscollection + '_' + method
+
+    last = db.tweets.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    if last is None:
+        print('no tweets')
+        return
+    highwatermark = last['_id']
+
+    db[statscollection].create_index([('u_id', 1), ('method', 1)])
+    db[statscollection].create_index([('method', 1), ('pending', 1)])
+    progress = db[progresscollection].find_one({'_id': jobname})
+    if progress is not None and progress.get('pending') is not None:
+        print('previous run did not finish adding tweets', progress['pending'], 'rebuilding statistics from all tweets')
+        db[statscollection].delete_many({'method': method})
+        progress = None
+    lowwatermark = None if progress is None else progress['highwatermark']
+
+    # 1) new tweets to location statistics
+    ntweets = 0
+    while True:
+        idquery = {'$lte': highwatermark} if lowwatermark is None else {'$gt': lowwatermark, '$lte': highwatermark}
+        df = tweets_table(db, {'_id': idquery}, dataformat=dataformat, withid=True, sort=[('_id', 1)], limit=chunksize)
+        if df.shape[0] == 0:
+            break
+        lastid = df['_id'].iloc[-1]
+        # in-progress marker: stays in the progress document if the statistics update fails
+        db[progresscollection].update_one({'_id': jobname},
+                                          {'$set': {'pending': {'from': lowwatermark, 'to': lastid}}}, upsert=True)
+        update_location_statistics(db, df.drop(columns='_id'), method=method, statscollection=statscollection)
+        lowwatermark = lastid
+        ntweets += df.shape[0]
+        db[progresscollection].update_one({'_id': jobname},
+                                          {'$set': {'highwatermark': lowwatermark}, '$unset': {'pending': ''}})
+        print('tweets added to statistics', ntweets, 'time:', time.time() - starttime)
+
+    # 2) home and work of users with new tweets (statistics marked as pending, also from interrupted runs)
+    homefield = 'hex9' if method == 'hex9' else 'home'
+    updatedusers = sorted(db[statscollection].distinct('u_id', {'method': method, 'pending': True}))
+    for i in range(0, len(updatedusers), nusers):
+        uids = updatedusers[i:i + nusers]
+        results = findhome_from_statistics(db, uids, method=method, statscollection=statscollection)
+
+        requests = []
+        for uid in uids:
+            if results.completed(uid):
+                update = {'$set': results.dicttopopulate(uid), '$unset': {'foundhomereason': ''}}
+            else:
+                update = {'$set': results.dicttopopulate(uid), '$unset': {homefield: ''}}
+            requests.append(UpdateOne({'u_id': uid}, update))
+
+        # statistics stay pending for users whose update failed
+        failed = set()
+        try:
+            db.users.bulk_write(requests, ordered=False)
+        except BulkWriteError as bwe:
+            print(bwe.details)
+            failed = set(uids[error['index']] for error in bwe.details['writeErrors'])
+        done = [uid for uid in uids if uid not in failed]
+        db[statscollection].update_many({'u_id': {'$in': done}, 'method': method}, {'$set': {'pending': False}})
+        print('users updated', min(i + nusers, len(updatedusers)), 'of', len(updatedusers))
+
+    print('total elapsed time ', time.time() - starttime)
@@ -0,0 +1,159 @@
+__author__ = 'Ricardo Pasquini'
+
+import json
+import time
+from contextlib import contextmanager
+
+
+class JobMetrics:
+    """Timers, counters and latency histograms of a long running job.
+
+    Each stage of an iteration (mongo read, pandas compute, bulk write...) is timed with stage, and processed rows
+    are reported with progress, which prints throughput, ETA and the time spent in each stage.
+    Metrics can be exported to a JSON lines file (one record per progress report) or to a Prometheus text file
+    (the file extension .prom selects Prometheus format).
+
+    Example:
+        metrics = JobMetrics('addhexjob', total=collectionsize, unit='tweets', path='addhexjob.jsonl')
+        with metrics.stage('read'):
+            df = pd.DataFrame(list(cursor))
+        metrics.progress(df.shape[0])
+        metrics.close()
+    """
+
+    buckets = (0.001, 0.01, 0.1, 1, 10, 60, float('inf'))  # upper bounds (seconds) of the latency histograms
+
+    def __init__(self, job, total=None, unit='rows', path=None, printprogress=True):
+        self.job = job
+        self.total = total  # rows to process, if known (for ETA)
+        self.unit = unit
+        self.path = path
+        self.exportformat = 'prometheus' if path is not None and path.endswith('.prom') else 'jsonl'
+        self.printprogress = printprogress
+        self.starttime = time.time()
+        self.processed = 0
+        self.iteration = 0
+        self.counters = {}
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block of code as stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        """Adds a duration to the latency histogram of stage name"""
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = {'count': 0, 'sum': 0.0, 'min': float('inf'), 'max': 0.0,
+                                         'buckets': [0] * len(self.buckets)}
+        stats['count'] += 1
+        stats['sum'] += seconds
+        stats['min'] = min(stats['min'], seconds)
+        stats['max'] = max(stats['max'], seconds)
+        stats['buckets'][next(i for i, bound in enumerate(self.buckets) if seconds <= bound)] += 1
+
+    def count(self, name, n=1):
+        """Increments counter name"""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def elapsed(self):
+        return time.time() - self.starttime
+
+    def rate(self):
+        """Processed rows per second"""
+        return self.processed / max(self.elapsed(), 1e-9)
+
+    def eta(self):
+        """Estimated seconds to finish, None if total is unknown"""
+        if self.total is None or self.processed == 0:
+            return None
+        return max(self.total - self.processed, 0) / self.rate()
+
+    def progress(self, n, pending=None):
+        """
+        Reports n processed rows at the end of an iteration
+
+        :param pending: rows still pending, if known (updates total)
+        """
+        self.processed += n
+        self.iteration += 1
+        if pending is not None:
+            self.total = self.processed + pending
+
+        if self.printprogress:
+            eta = self.eta()
+            stages = ' '.join('{}: {:.2f}s'.format(name, stats['sum']) for name, stats in self.stages.items())
+            print('{} iter: {} {}: {}{} rate: {:.1f} {}/s eta: {} {}'.format(
+                self.job, self.iteration, self.unit, self.processed,
+                '' if self.total is None else '/' + str(self.total), self.rate(), self.unit,
+                'unknown' if eta is None else '{:.0f}s'.format(eta), stages))
+
+        if self.path is not None and self.exportformat == 'jsonl':
+            self.export()
+
+    def summary(self):
+        """Metrics as a dict"""
+        return {'job': self.job, 'time': time.time(), 'elapsed': self.elapsed(), 'iteration': self.iteration,
+                'unit': self.unit, 'processed': self.processed, 'total': self.total, 'rate': self.rate(),
+                'eta': self.eta(), 'counters': dict(self.counters),
+                'stages': {name: dict(stats, mean=stats['sum'] / stats['count'], buckets=list(stats['buckets']))
+                           for name, stats in self.stages.items()}}
+
+    def report(self):
+        """Prints the time spent in each stage (and its share of the elapsed time)"""
+        total = self.elapsed()
+        print(self.job, 'total elapsed time', self.elapsed(), self.unit, self.processed, 'rate', self.rate())
+        for name, stats in self.stages.items():
+            print('  {:<16} total {:9.2f}s ({:5.1f}%)  calls {:7d}  mean {:.4f}s  max {:.4f}s'.format(
+                name, stats['sum'], 100 * stats['sum'] / max(total, 1e-9), stats['count'],
+                stats['sum'] / stats['count'], stats['max']))
+        for name, value in self.counters.items():
+            print('  {:<16} {}'.format(name, value))
+
+    def prometheus_text(self):
+        """Metrics in Prometheus text exposition format"""
+        job = 'job="{}"'.format(self.job)
+        lines = ['# TYPE twitter_job_stage_seconds histogram']
+        for name, stats in self.stages.items():
+            labels = '{},stage="{}"'.format(job, name)
+            cumulative = 0
+            for bound, n in zip(self.buckets, stats['buckets']):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('twitter_job_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, cumulative))
+            lines.append('twitter_job_stage_seconds_sum{{{}}} {}'.format(labels, stats['sum']))
+            lines.append('twitter_job_stage_seconds_count{{{}}} {}'.format(labels, stats['count']))
+
+        lines.append('# TYPE twitter_job_processed_total counter')
+        lines.append('twitter_job_processed_total{{{},unit="{}"}} {}'.format(job, self.unit, self.processed))
+        lines.append('# TYPE twitter_job_counter_total counter')
+        for name, value in self.counters.items():
+            lines.append('twitter_job_counter_total{{{},name="{}"}} {}'.format(job, name, value))
+        lines.append('# TYPE twitter_job_rate gauge')
+        lines.append('twitter_job_rate{{{}}} {}'.format(job, self.rate()))
+        eta = self.eta()
+        if eta is not None:
+            lines.append('# TYPE twitter_job_eta_seconds gauge')
+            lines.append('twitter_job_eta_seconds{{{}}} {}'.format(job, eta))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path=None):
+        """Appends a JSON line with the summary, or rewrites the Prometheus text file"""
+        path = path or self.path
+        if path.endswith('.prom'):
+            with open(path, 'w') as f:
+                f.write(self.prometheus_text())
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.summary()) + '\n')
+
+    def close(self):
+        """Prints the stages report and exports final metrics"""
+        self.report()
+        if self.path is not None:
+            self.export()
@@ -1,31 +1,120 @@
+import hashlib
+from functools import lru_cache
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Polygon
+import numpy as np
 from h3 import h3
-from shapely.geometry import Point
-from pandas.io.json import json_normalize
 
-def hex_to_polygon(hexid):
-    """Transforms single hexid to shapely hexagonal polygon
+# geopandas and shapely are imported by the functions that build geometries, so that counting jobs
+# (hex ids as strings and integers, k-ring smoothing) do not load them
+
+def hexs_to_int(hexids):
+    """Transforms hex ids (h3 indexes as strings) to an array of 64 bits integers"""
+    return np.array([int(hexid, 16) for hexid in hexids], dtype=np.uint64)
+
+
+def int_to_hexs(hexints):
+    """Transforms an array of 64 bits integers to hex ids (h3 indexes as strings)"""
+    return np.array([format(int(hexint), 'x') for hexint in hexints], dtype=object)
+
+
+def hex_to_str(hexid):
+    """Hex id as a string, from a string or a 64 bits integer (compact storage of hex ids in tweets collection)"""
+    if hexid is None or isinstance(hexid, str):
+        return hexid
+    return format(int(hexid), 'x')
+
+
+def hex_to_int(hexid):
+    """Hex id as a python int, from a string or a 64 bits integer.
+    The highest bit of h3 indexes is always 0, so they are stored in mongo as signed 64 bits integers (BSON long)"""
+    if hexid is None:
+        return None
+    return int(hexid, 16) if isinstance(hexid, str) else int(hexid)
+
+
+def hexs_to_str(hexids):
+    """Transforms hex ids stored as strings, as 64 bits integers or mixed to an array of strings"""
+    return np.array([hex_to_str(hexid) for hexid in hexids], dtype=object)
+
+
+def hexs_to_parents(hexids, resolution):
+    """
+    Parent hexagons at a coarser resolution (same result as h3.h3_to_parent), computed for an array of hexagons
+    with bit operations on the 64 bits integer index
 
+    :param hexids: hex ids as strings or as 64 bits integers (any integer dtype, or a list of ints as read from mongo)
+    :return: parents, as strings for strings and as an uint64 array for integers
     """
-    list_of_coords_list=h3.h3_to_geo_boundary(h3_address=hexid,geo_json=False)
+    hexarray = np.asarray(hexids)
+    asstrings = hexarray.dtype.kind not in 'iu'
+    if asstrings:  # strings (or strings and integers mixed, during a migration)
+        hexints = np.array([hex_to_int(hexid) for hexid in hexarray], dtype=np.uint64)
+    else:
+        hexints = hexarray.astype(np.uint64)
+
+    resolutions = (hexints >> np.uint64(52)) & np.uint64(15)
+    if len(hexints) > 0 and resolutions.min() < resolution:
+        raise ValueError('hexagons with resolution lower than ' + str(resolution))
 
-    #return Polygon([tuple(i) for i in list_of_coords_list])
+    # resolution field (bits 52-55) set to the parent resolution, and digits of finer resolutions set to 7
+    parents = hexints & ~np.uint64(15 << 52) | np.uint64(resolution << 52)
+    parents = parents | np.uint64((1 << ((15 - resolution) * 3)) - 1)
+    return int_to_hexs(parents) if asstrings else parents
 
+
+@lru_cache(maxsize=2**18)
+def hex_boundary(hexid):
+    """Boundary coordinates of a hexid as a tuple of (lon, lat) pairs. Cached by hexid"""
+    list_of_coords_list=h3.h3_to_geo_boundary(hexid, False)
     # Corrijo que las coordenadas que necesita geopandas tienen que estar invertidas con logitud primero y latitud despues
-    return Polygon([tuple([pair[1],pair[0]]) for pair in list_of_coords_list])
+    return tuple((pair[1], pair[0]) for pair in list_of_coords_list)
+
+
+@lru_cache(maxsize=2**18)
+def hex_to_polygon(hexid):
+    """Transforms single hexid to shapely hexagonal polygon. Cached by hexid, so polygons used again
+    across maps are not rebuilt
+
+    """
+    from shapely.geometry import Polygon
+    return Polygon(hex_boundary(hexid))
+
+
+def hexs_to_polygons(hexids):
+    """Transforms an array of hex ids to an array of shapely polygons.
+    Boundaries of each distinct hexid are computed once into flat coordinate arrays, and polygons are built in a
+    single vectorized call when shapely supports it (shapely>=2)"""
+    codes, uniquehexs = pd.factorize(np.asarray(hexids, dtype=object))
+    try:
+        from shapely import polygons as shapely_polygons
+    except ImportError:  # shapely<2: polygons from the cache
+        uniquepolygons = np.empty(len(uniquehexs), dtype=object)
+        uniquepolygons[:] = [hex_to_polygon(hexid) for hexid in uniquehexs]
+        return uniquepolygons[codes]
+
+    boundaries = [hex_boundary(hexid) for hexid in uniquehexs]
+    nvertices = np.array([len(boundary) for boundary in boundaries])
+    uniquepolygons = np.empty(len(uniquehexs), dtype=object)
+    for n in np.unique(nvertices):  # pentagons and distorted hexagons do not have 6 vertices
+        positions = np.flatnonzero(nvertices == n)
+        coordinates = np.array([boundaries[i] for i in positions], dtype=np.float64).reshape(-1, n, 2)
+        uniquepolygons[positions] = shapely_polygons(coordinates)
+    return uniquepolygons[codes]
+
+
+def hexs_to_centroids(hexids):
+    """Centroids of an array of hex ids as arrays of latitudes and longitudes. Each distinct hexid is computed once"""
+    codes, uniquehexs = pd.factorize(np.asarray(hexids, dtype=object))
+    centroids = np.array([h3.h3_to_geo(hexid) for hexid in uniquehexs], dtype=np.float64).reshape(-1, 2)
+    return centroids[codes, 0], centroids[codes, 1]
 
 
 
 def hexlist_to_geodataframe(list_hexagons):
     """Transforms a list of hex ids (h3 indexes) to GeoDataFrame"""
+    import geopandas as gpd
     df=pd.DataFrame(list_hexagons, columns=['hexid'])
-    def f(x):
-        #return h3.h3_to_geo_boundary(h3_address=x['hexid'],geo_json=False)
-        return hex_to_polygon(x['hexid'])
-
-    gdf = gpd.GeoDataFrame(df, geometry=df.apply(f, axis=1))
+    gdf = gpd.GeoDataFrame(df, geometry=hexs_to_polygons(df['hexid']))
     return gdf
 
 
@@ -36,9 +125,9 @@ def df_with_hexid_to_gdf(df, hexcolname='_id'):
     :param hexcolname: name of the hexid column
     :returns gdf
     """
-    df_geometry=hexlist_to_geodataframe(df[hexcolname].to_list())
+    import geopandas as gpd
     #Creando el geodataframe
-    gdf=gpd.GeoDataFrame(df, geometry=df_geometry['geometry'])
+    gdf=gpd.GeoDataFrame(df, geometry=hexs_to_polygons(df[hexcolname]))
     gdf.crs = {'init': 'epsg:4326', 'no_defs': True}
     return gdf
 
@@ -49,26 +138,63 @@ def df_with_hexid_to_centroids_gdf(df, hexcolname='hexid'):
     :param hexcolname: name of the hexid column
     :returns gdf
     """
-    seriesofcoordinates=df[hexcolname].apply(h3.h3_to_geo)
-    geometria=seriesofcoordinates.apply(lambda row: Point(row[1],row[0]))
-    gdf=gpd.GeoDataFrame(df, geometry=geometria)
+    import geopandas as gpd
+    lat, lon = hexs_to_centroids(df[hexcolname])
+    gdf=gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(lon, lat))
     return gdf
 
 
 
 
+# sparse k-ring matrices already built, by (hexagons, k). Only the last ones are kept
+_kring_matrices = {}
+_kring_matrices_maxsize = 8
+
+
+def kring_matrix(hexids, k):
+    """ Sparse k-ring adjacency matrix of a set of hexagons.
+    Element (i, j) is 1 if output hexagon i is in the k-ring of input hexagon j. Output hexagons are all hexagons
+    in the k-rings of the input hexagons. Matrices are cached by (set of hexagons, k)
+
+    :param hexids: list of distinct hex ids
+    :return: sorted array of output hexagons as integers, sparse matrix (output hexagons x input hexagons)
+    """
+    from scipy import sparse
+
+    hexints = hexs_to_int(hexids)
+    key = (hashlib.sha1(hexints.tobytes()).hexdigest(), len(hexints), k)
+    if key in _kring_matrices:
+        return _kring_matrices[key]
+
+    rings = [list(h3.k_ring(hexid, k)) for hexid in hexids]
+    columns = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+    ringints = hexs_to_int([hexid for ring in rings for hexid in ring])
+    outhexs, rows = np.unique(ringints, return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(ringints)), (rows.ravel(), columns)), shape=(len(outhexs), len(hexints)))
+
+    if len(_kring_matrices) >= _kring_matrices_maxsize:
+        del _kring_matrices[next(iter(_kring_matrices))]
+    _kring_matrices[key] = (outhexs, matrix)
+    return outhexs, matrix
+
+
 def kring_smoothing(df, hex_col, metric_col, k):
-    dfk = df[[hex_col]]
-    dfk.index = dfk[hex_col]
-    dfs =  (dfk[hex_col]
-                 .apply(lambda x: pd.Series(list(h3.k_ring(x,k)))).stack()
-                 .to_frame('hexk').reset_index(1, drop=True).reset_index()
-                 .merge(df[[hex_col,metric_col]]).fillna(0)
-                 .groupby(['hexk'])[[metric_col]].sum().divide((1 + 3 * k * (k + 1)))
-                 .reset_index()
-                 .rename(index=str, columns={"hexk": hex_col}))
-    dfs['lat'] = dfs[hex_col].apply(lambda x: h3.h3_to_geo(x)[0])
-    dfs['lng'] = dfs[hex_col].apply(lambda x: h3.h3_to_geo(x)[1])
+    """ K-ring smoothing: each hexagon gets the sum of the metric in its k-ring divided by the number of hexagons
+    in a k-ring. Computed as a sparse matrix product for one or several metric columns at once
+
+    :param hex_col: name of the hexid column
+    :param metric_col: column (or list of columns) to be smooth. Values of repeated hexagons are added
+    :return: dataframe with hex_col, smoothed columns, lat and lng of all hexagons in the k-rings
+    """
+    metric_cols = [metric_col] if isinstance(metric_col, str) else list(metric_col)
+
+    values = df.groupby(hex_col)[metric_cols].sum()
+    outhexs, matrix = kring_matrix(list(values.index), k)
+    smoothed = matrix.dot(values.to_numpy(dtype=np.float64)) / (1 + 3 * k * (k + 1))
+
+    dfs = pd.DataFrame(smoothed, columns=metric_cols)
+    dfs.insert(0, hex_col, int_to_hexs(outhexs))
+    dfs['lat'], dfs['lng'] = hexs_to_centroids(dfs[hex_col])
     return dfs
 
 
@@ -76,12 +202,11 @@ def kring_smoother(hexgdf, metric_col='totalpobl', hexcolname='hexid', k=2):
 
     """ Applies a Kring smoother to hex dataframe, returns a gdf ready to plot
     :param hexgdf: name of hex level geodataframe
-    :param metric_col: column to be smooth
+    :param metric_col: column (or list of columns) to be smooth
     :return: Hex gdf with smoothed column
     """""
     smooth_df=kring_smoothing(hexgdf, hexcolname, metric_col=metric_col, k=k)
-    smooth_df2=pd.read_json(smooth_df.to_json(orient='records'), orient='records') #wrap> reconstructing the dataframe to avoid unkown bug with kring_smoothing
-    hexsmoothgdf=df_with_hexid_to_gdf(smooth_df2, hexcolname=hexcolname)
+    hexsmoothgdf=df_with_hexid_to_gdf(smooth_df, hexcolname=hexcolname)
 
     return hexsmoothgdf
 
@@ -95,6 +220,8 @@ def fill_gdf_with_hexs(gdf, hexresolution=9, dissolve=True):
     Dissolve: Dissolves the gdf into a single polygon. Default is True
 
     """
+    import geopandas as gpd
+    from pandas.io.json import json_normalize
 
     #The polyfill will not work if the geometry is not in the basic projection
 
@@ -124,3 +251,105 @@ def fill_gdf_with_hexs(gdf, hexresolution=9, dissolve=True):
 
     return list_hexagons
 
+
+
+def _densify_ring(coords, spacing):
+    "Points along a ring (array of lon, lat vertices) at most spacing degrees apart, vertices included"
+    coords = np.asarray(coords, dtype=np.float64)
+    points = [coords[:1]]
+    for start, end in zip(coords[:-1], coords[1:]):
+        n = max(int(np.ceil(np.hypot(*(end - start)) / spacing)), 1)
+        points.append(start + np.outer(np.arange(1, n + 1) / n, end - start))
+    return np.concatenate(points)
+
+
+def _hex_edge_degrees(lat, lon, hexresolution):
+    "Shortest edge (in degrees) of the hexagon containing a point"
+    boundary = np.array(hex_boundary(h3.geo_to_h3(lat, lon, hexresolution)))
+    return np.hypot(*(boundary - np.roll(boundary, 1, axis=0)).T).min()
+
+
+def polygon_hexs(geometry, hexresolution=10):
+    """ Hexagons covering a polygon, classified as interior (completely within the polygon) or boundary hexagons
+
+    Polyfill only returns hexagons with centroid inside the polygon, so hexagons along all the rings of the polygon
+    (exterior and holes, with points closer than half a hexagon edge) and neighbors of all of them are also checked.
+    Thin polygons (narrower than a hexagon) have no polyfill hexagons at all.
+
+    :param geometry: shapely Polygon or MultiPolygon in epsg:4326 (lon, lat) coordinates
+    :return: list of interior hexids, list of boundary hexids
+    """
+    from shapely.geometry import mapping
+    from shapely.prepared import prep
+
+    polygons = geometry.geoms if geometry.geom_type == 'MultiPolygon' else [geometry]
+
+    candidates = set()
+    for polygon in polygons:
+        candidates.update(h3.polyfill(mapping(polygon), hexresolution, geo_json_conformant=True))
+        lon, lat = polygon.exterior.coords[0]
+        spacing = _hex_edge_degrees(lat, lon, hexresolution) / 2
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            candidates.update(h3.geo_to_h3(lat, lon, hexresolution) for lon, lat in _densify_ring(ring.coords, spacing))
+    candidates = set(neighbor for hexid in candidates for neighbor in h3.k_ring(hexid, 1))
+
+    preparedgeometry = prep(geometry)
+    interior, boundary = [], []
+    for hexid in candidates:
+        hexpolygon = hex_to_polygon(hexid)
+        if preparedgeometry.contains(hexpolygon):
+            interior.append(hexid)
+        elif preparedgeometry.intersects(hexpolygon):
+            boundary.append(hexid)
+    return interior, boundary
+
+
+def polygons_hex_index(gdf, codecol='COD_2010_1', hexresolution=10):
+    """ Polygon to hexagon index of a geodataframe of polygons (for instance census radios).
+
+    :param codecol: name of the polygon code column
+    :return: dataframe with code, hexid and interior columns. Interior hexagons belong to a single polygon,
+             boundary hexagons (interior False) require a point in polygon check
+    """
+    gdf = gdf.to_crs({'init': 'epsg:4326'})
+    rows = []
+    for code, geometry in zip(gdf[codecol], gdf.geometry):
+        interior, boundary = polygon_hexs(geometry, hexresolution=hexresolution)
+        rows.extend((code, hexid, True) for hexid in interior)
+        rows.extend((code, hexid, False) for hexid in boundary)
+    return pd.DataFrame(rows, columns=['code', 'hexid', 'interior'])
+
+
+def points_to_polygons_with_hexindex(lon, lat, hexindex, polygons, hexids=None, hexresolution=10):
+    """ Assigns points to the polygons containing them, using a polygon to hexagon index (see polygons_hex_index).
+    Points in interior hexagons are assigned with a hexid lookup, only points in boundary hexagons are checked
+    with point in polygon tests.
+
+    :param lon: array of longitudes
+    :param lat: array of latitudes
+    :param hexindex: polygon to hexagon index
+    :param polygons: dict of shapely polygons by code
+    :param hexids: hexids of the points at the index resolution. Computed from coordinates if not given
+    :return: array with the code of the polygon containing each point (None if there is none)
+    """
+    from shapely.geometry import Point
+    from shapely.prepared import prep
+
+    if hexids is None:
+        hexids = [h3.geo_to_h3(y, x, hexresolution) for x, y in zip(lon, lat)]
+    points = pd.DataFrame({'hexid': np.asarray(hexids, dtype=object), 'lon': lon, 'lat': lat})
+    codes = np.full(points.shape[0], None, dtype=object)
+
+    interior = hexindex.loc[hexindex['interior']].drop_duplicates('hexid').set_index('hexid')['code']
+    interiorcodes = points['hexid'].map(interior)
+    ininterior = interiorcodes.notna().to_numpy()
+    codes[ininterior] = interiorcodes[ininterior].to_numpy()
+
+    boundary = hexindex.loc[~hexindex['interior'], ['hexid', 'code']]
+    pairs = points.loc[~ininterior].reset_index().merge(boundary, on='hexid')
+    preparedpolygons = {code: prep(polygons[code]) for code in pairs['code'].unique()}
+    inside = [preparedpolygons[code].contains(Point(x, y)) for code, x, y in zip(pairs['code'], pairs['lon'], pairs['lat'])]
+    pairs = pairs.loc[np.asarray(inside, dtype=bool)].drop_duplicates('index')
+    codes[pairs['index'].to_numpy()] = pairs['code'].to_numpy()
+
+    return codes
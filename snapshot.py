@@ -0,0 +1,191 @@
+__author__ = 'Ricardo Pasquini'
+
+import os
+import json
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from h3 import h3
+import home_location as home
+import analysis as a
+import dataaccess
+
+# Columnar snapshot of the tweets collection (and users homes) as partitioned parquet files.
+# The home location and counting engines can run directly off these files, without a running mongodb.
+#
+# Example:
+#    export_tweets_snapshot(db, './snapshot')
+#    export_users_snapshot(db, './snapshot')
+#    homes = findhome_batch_from_snapshot('./snapshot', method='hex9')
+#    counts = counts_from_snapshot('./snapshot')
+
+
+def _parquet():
+    "pyarrow is only required by the snapshot functions"
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('pyarrow is required to write and read parquet snapshots (conda install pyarrow)')
+    return pyarrow, pyarrow.parquet
+
+
+def _read_metadata(path):
+    with open(os.path.join(path, 'metadata.json')) as f:
+        return json.load(f)
+
+
+def _hex_partitions(hexids, partitionresolution):
+    "Partition (parent hexagon) of each hex id. Each distinct hex id is converted once"
+    codes, uniquehexs = pd.factorize(np.asarray(hexids, dtype=object))
+    parents = np.array([h3.h3_to_parent(hexid, partitionresolution) for hexid in uniquehexs], dtype=object)
+    return parents[codes]
+
+
+def _tweets_chunk_fields(dataformat='raw'):
+    "Columns and field paths of the snapshot tweets (see dataaccess.read_columns), with _id to read them in chunks"
+    fields = {'_id': '_id', 'u_id': 'u_id'}
+    fields.update(dataaccess.coordinate_fields(dataformat))
+    fields.update({'hex9': 'hex.9', 'hex10': 'hex.10', 'created_at': 'created_at'})
+    return fields
+
+
+def export_tweets_snapshot(db, path, partition_by='hex', partitionresolution=5, nuidranges=64, chunksize=500000,
+                           dataformat='raw', collectionname='tweets'):
+    """
+    Writes tweets (u_id, lat, lon, hex9, hex10, created_at) as a partitioned parquet dataset in path/tweets.
+    An existing snapshot in path is replaced: the dataset is written to path/tweets.tmp and renamed when complete
+
+    :param partition_by: 'hex' partitions by parent hexagon of hex9 at partitionresolution,
+                         'uid' partitions by ranges of u_id (nuidranges ranges with similar number of users)
+    :param chunksize: number of tweets read and written at a time
+    :param dataformat: 'raw' if coordinates are in lat and lon fields, otherwise read from mongo location field
+    """
+    pa, pq = _parquet()
+    starttime = time.time()
+
+    metadata = {'partition_by': partition_by, 'collection': collectionname}
+    if partition_by == 'hex':
+        partitioncol = 'hexpart'
+        metadata['partitionresolution'] = partitionresolution
+    else:
+        partitioncol = 'uidrange'
+        uids = np.sort(np.array(db[collectionname].distinct('u_id'), dtype=np.int64))
+        edges = np.unique(uids[np.linspace(0, len(uids) - 1, nuidranges + 1).astype(np.int64)[1:-1]])
+        metadata['uidedges'] = edges.tolist()
+
+    # write_to_dataset adds files to the partitions, so a previous (or interrupted) export would be read twice
+    tmppath = os.path.join(path, 'tweets.tmp')
+    if os.path.exists(tmppath):
+        shutil.rmtree(tmppath)
+
+    def write(df):
+        if partition_by == 'hex':
+            df[partitioncol] = _hex_partitions(df['hex9'], partitionresolution)
+        else:
+            df[partitioncol] = np.searchsorted(edges, df['u_id'].to_numpy(), side='right')
+        pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), root_path=tmppath,
+                            partition_cols=[partitioncol])
+        return df.shape[0]
+
+    # chunks of typed columns, read in _id order from the last _id of the previous chunk
+    rows = 0
+    query = {}
+    fields = _tweets_chunk_fields(dataformat)
+    while True:
+        df = dataaccess.read_columns(db[collectionname], query, fields, sort=[('_id', 1)], limit=chunksize,
+                                     batch_size=min(chunksize, 100000))
+        if df.shape[0] == 0:
+            break
+        query = {'_id': {'$gt': df['_id'].iloc[-1]}}
+        rows += write(df.drop(columns='_id'))
+        print('tweets written:', rows, ' time:', time.time() - starttime)
+
+    if os.path.exists(os.path.join(path, 'tweets')):
+        shutil.rmtree(os.path.join(path, 'tweets'))
+    if rows > 0:
+        os.rename(tmppath, os.path.join(path, 'tweets'))
+
+    metadata['rows'] = rows
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+    print('total tweets:', rows, ' total elapsed time:', time.time() - starttime)
+
+
+def export_users_snapshot(db, path, resolution='9'):
+    """Writes users home hexagons (u_id, hex9) to path/users.parquet"""
+    pa, pq = _parquet()
+    hexfieldname_indb = 'hex' + resolution + "." + 'hex' + resolution
+    docs = list(db.users.find({hexfieldname_indb: {'$exists': True}}, {'_id': 0, 'u_id': 1, hexfieldname_indb: 1}))
+    df = pd.DataFrame({'u_id': np.array([doc['u_id'] for doc in docs], dtype=np.int64),
+                       'hex' + resolution: [doc['hex' + resolution]['hex' + resolution] for doc in docs]})
+    if not os.path.exists(path):
+        os.makedirs(path)
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), os.path.join(path, 'users.parquet'))
+
+
+def read_tweets_snapshot(path, columns=None, hexs=None, uids=None):
+    """
+    Reads tweets from a snapshot. Only partitions that can contain the requested hexagons or users are read
+
+    :param columns: list of columns. Default is all
+    :param hexs: optional list of hex ids (resolution 9) to read
+    :param uids: optional list of user ids to read
+    :return: dataframe of tweets
+    """
+    pa, pq = _parquet()
+    metadata = _read_metadata(path)
+    partitioncol = 'hexpart' if metadata['partition_by'] == 'hex' else 'uidrange'
+
+    filters = None
+    if hexs is not None and metadata['partition_by'] == 'hex':
+        partitions = set(h3.h3_to_parent(hexid, metadata['partitionresolution']) for hexid in hexs)
+        filters = [(partitioncol, 'in', sorted(partitions))]
+    if uids is not None and metadata['partition_by'] == 'uid':
+        partitions = np.unique(np.searchsorted(metadata['uidedges'], np.asarray(uids, dtype=np.int64), side='right'))
+        filters = [(partitioncol, 'in', partitions.tolist())]
+
+    readcolumns = None
+    if columns is not None:
+        readcolumns = list(columns) + [col for col in ['hex9', 'u_id'] if col not in columns]
+    df = pq.read_table(os.path.join(path, 'tweets'), columns=readcolumns, filters=filters).to_pandas()
+    df = df.drop(columns=[partitioncol], errors='ignore')
+
+    if hexs is not None:
+        df = df.loc[df['hex9'].isin(list(hexs))]
+    if uids is not None:
+        df = df.loc[df['u_id'].isin(list(uids))]
+    if columns is not None:
+        df = df[list(columns)]
+    return df.reset_index(drop=True)
+
+
+def read_users_snapshot(path):
+    """Reads users home hexagons from a snapshot"""
+    pa, pq = _parquet()
+    return pq.read_table(os.path.join(path, 'users.parquet')).to_pandas()
+
+
+def findhome_batch_from_snapshot(path, method='hex9', uids=None):
+    """
+    Finds home for users (all by default) with home_location.findhome_batch, reading tweets from a snapshot
+
+    :return: home_location.BatchHomelocation
+    """
+    tweets = read_tweets_snapshot(path, columns=['u_id', 'lat', 'lon', 'hex9', 'created_at'], uids=uids)
+    return home.findhome_batch(tweets, method=method)
+
+
+def counts_from_snapshot(path, contiguity=1, freq='Q'):
+    """
+    Counts by residents and non residents for all hexagons (as analysis.countandpopulatejob_all), reading tweets and
+    users homes from a snapshot
+
+    :return: long format counts (see analysis.counts_by_area_and_period)
+    """
+    tweets = read_tweets_snapshot(path, columns=['u_id', 'hex9', 'created_at']).rename(columns={'hex9': 'hex'})
+    homes = read_users_snapshot(path)
+    tweets['home'] = tweets['u_id'].map(pd.Series(homes['hex9'].to_numpy(), index=homes['u_id'].to_numpy()))
+    tweets = a.classify_residents(tweets, contiguity=contiguity)
+    return a.counts_by_area_and_period(tweets, areacol='hex', freq=freq)
@@ -0,0 +1,42 @@
+__author__ = 'Ricardo Pasquini'
+
+import os
+import sys
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock = pytest.importorskip('mongomock')
+import dataaccess
+import home_location as home
+
+
+def _half_migrated_collection():
+    "Tweets with created_at in milliseconds since epoch and, for the migrated half, as dates"
+    collection = mongomock.MongoClient().db.tweets
+    dates = pd.date_range('2014-01-01', periods=6, freq='7D') + pd.Timedelta(milliseconds=250)
+    docs = []
+    for i, date in enumerate(dates):
+        ms = int(date.value // 10**6)
+        docs.append({'u_id': i, 'created_at': datetime.datetime.utcfromtimestamp(ms / 1000) if i % 2 else ms})
+    collection.insert_many(docs)
+    return collection, dates
+
+
+def test_read_columns_mixed_dates():
+    collection, dates = _half_migrated_collection()
+    df = dataaccess.read_columns(collection, {}, {'u_id': 'u_id', 'created_at': 'created_at'}, sort=[('u_id', 1)])
+    assert df['created_at'].dtype == 'datetime64[ns]'
+    assert list(df['created_at']) == list(dates)
+
+
+def test_created_at_to_datetime_mixed():
+    collection, dates = _half_migrated_collection()
+    created_at = pd.Series([doc['created_at'] for doc in collection.find().sort('u_id', 1)])
+    converted = home.created_at_to_datetime(created_at)
+    # milliseconds are truncated to seconds, dates are kept as they are
+    expected = [date.floor('s') if i % 2 == 0 else date for i, date in enumerate(dates)]
+    assert list(converted) == expected
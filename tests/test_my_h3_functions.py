@@ -0,0 +1,73 @@
+__author__ = 'Ricardo Pasquini'
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+gpd = pytest.importorskip('geopandas')
+from shapely.geometry import Point, Polygon, box
+import my_h3_functions as myh3
+
+
+def _contains_join(lon, lat, polygons):
+    "Code of the polygon containing each point with plain point in polygon tests (None if there is none)"
+    codes = np.full(len(lon), None, dtype=object)
+    for code, polygon in polygons.items():
+        inside = np.array([polygon.contains(Point(x, y)) for x, y in zip(lon, lat)])
+        codes[inside] = code
+    return codes
+
+
+def _sliver():
+    "Thin diagonal polygon of about 3 km x 15 meters, narrower than a resolution 10 hexagon"
+    return Polygon([(-58.4000, -34.6000), (-58.3700, -34.5850), (-58.36992, -34.58513), (-58.39992, -34.60013)])
+
+
+def _with_hole():
+    "Square of about 2 km with a hole that leaves walls of about 20 meters"
+    return box(-58.45, -34.62, -58.43, -34.60).difference(box(-58.4498, -34.6198, -58.4302, -34.6002))
+
+
+@pytest.mark.parametrize('polygon', [_sliver(), _with_hole()])
+def test_points_to_polygons_with_hexindex_matches_contains_join(polygon):
+    polygons = {'a': polygon}
+    gdf = gpd.GeoDataFrame({'COD_2010_1': ['a']}, geometry=[polygon], crs='epsg:4326')
+    hexindex = myh3.polygons_hex_index(gdf, hexresolution=10)
+
+    rng = np.random.RandomState(0)
+    minx, miny, maxx, maxy = polygon.bounds
+    lon = rng.uniform(minx, maxx, 20000)
+    lat = rng.uniform(miny, maxy, 20000)
+
+    expected = _contains_join(lon, lat, polygons)
+    codes = myh3.points_to_polygons_with_hexindex(lon, lat, hexindex, polygons, hexresolution=10)
+    assert (expected == 'a').sum() > 100
+    assert list(codes) == list(expected)
+
+
+def test_polygon_hexs_cover_polygon():
+    for polygon in [_sliver(), _with_hole()]:
+        interior, boundary = myh3.polygon_hexs(polygon, hexresolution=10)
+        covered = myh3.hexs_to_polygons(interior + boundary)
+        from shapely.ops import unary_union
+        assert unary_union(list(covered)).buffer(1e-9).contains(polygon)
+        assert all(polygon.contains(hexpolygon) for hexpolygon in myh3.hexs_to_polygons(interior))
+
+
+@pytest.mark.parametrize('form', ['int64', 'list', 'uint64'])
+def test_hexs_to_parents_integers(form):
+    from h3 import h3
+    hexids = [h3.geo_to_h3(lat, lon, 10) for lat, lon in [(-34.60, -58.38), (-34.62, -58.44), (-34.55, -58.46)]]
+    hexints = [int(hexid, 16) for hexid in hexids]
+    if form == 'list':
+        values = hexints
+    else:
+        values = np.array(hexints, dtype=form)
+
+    parents = myh3.hexs_to_parents(values, 7)
+    assert parents.dtype == np.uint64
+    assert list(myh3.int_to_hexs(parents)) == [h3.h3_to_parent(hexid, 7) for hexid in hexids]
+    assert list(myh3.hexs_to_parents(hexids, 7)) == [h3.h3_to_parent(hexid, 7) for hexid in hexids]